@@ -1,6 +1,7 @@
 #!/usr/bin/python
 import argparse
 from Bio import SeqIO
+from fasta_index import FastaIndex
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -29,13 +30,22 @@ if __name__ == '__main__':
     # # outfile2 = path + "rename.tsv"
 
 
-    # create a list of the existing sequences
-    print('\n### Processing existing genomes...\n')
-    all_sequences = {}
-    for fasta in SeqIO.parse(open(genomes),'fasta'):
-        id, seq = fasta.description, fasta.seq
-        if id not in all_sequences: # avoid potential duplicates
-            all_sequences[id] = str(seq)
+    # load the list of pre-selected genomes, so only those are kept in memory
+    print('\n### Loading list of pre-selected genomes...\n')
+    keep_ids = []
+    wanted = set()
+    for id in sorted(open(keep, "r").readlines()):
+        if id[0] not in ["#", "\n"]:
+            id = id.strip()
+            if id not in wanted:
+                keep_ids.append(id)
+                wanted.add(id)
+
+    # index the existing sequences, loading only those listed in keep.txt
+    print('### Processing existing genomes...\n')
+    with FastaIndex(genomes) as contextual:
+        all_sequences = len(contextual)
+        found_sequences = dict(contextual.iter_selected(wanted))
 
     # store only new sequences in a dictionary, ignoring existing ones
     print('### Processing newly sequenced genomes...\n')
@@ -49,14 +59,11 @@ if __name__ == '__main__':
     print('### Searching for pre-selected genomes to be added...\n')
     keep_sequences = {}
     mismatch = []
-    for id in sorted(open(keep, "r").readlines()):
-        if id[0] not in ["#", "\n"]:
-            id = id.strip()
-            if id not in keep_sequences.keys():
-                try:
-                    keep_sequences[id] = all_sequences[id]
-                except:
-                    mismatch.append(id)
+    for id in keep_ids:
+        if id in found_sequences:
+            keep_sequences[id] = found_sequences.pop(id)
+        else:
+            mismatch.append(id)
 
     # create a list of sequences to be ignored in all instances
     print('### Creating list of genomes to be ignored...\n')
@@ -105,7 +112,7 @@ if __name__ == '__main__':
 
     print('\n### Final result\n')
 
-    print('The contextual sequence file contains ' + str(len(all_sequences)) + ' sequences\n')
+    print('The contextual sequence file contains ' + str(all_sequences) + ' sequences\n')
 
     print('\t- ' + str(len(mismatch)) + ' sequences in keep.txt were NOT FOUND in the contextual sequences file.')
     print('\t- ' + str(len(keep_sequences)) + ' sequences ADDED from contextual sequences file.')
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+"""
+Timing of FASTA keep/remove filtering in masterkey.py and seqtree_handler.py, on synthetic data.
+
+A FASTA file with random sequences and a list of target headers sampled from
+it are generated in a temporary directory, and each script is run on them:
+    - masterkey.py keep, building the FASTA index (.fxi), and again reusing it;
+    - masterkey.py remove;
+    - seqtree_handler.py remove.
+
+Outputs are checked for the expected number of records, and both remove runs
+must produce identical files. Other versions of the scripts (e.g. a previous
+commit, checked out with 'git worktree') can be timed with --scripts.
+
+Usage:
+    python scripts/benchmark_fasta_filtering.py --records 500000 --targets 50000
+    python scripts/benchmark_fasta_filtering.py --records 50000 --targets 5000 --scripts /tmp/old/scripts
+"""
+
+import argparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+
+
+def make_fasta(fasta, size, length, seed=7):
+    """ Write 'size' records with random sequences of about 'length' bases, in 60-base lines; return their headers """
+    rng = random.Random(seed)
+    headers = []
+    with open(fasta, 'w') as outfile:
+        for i in range(size):
+            header = 'hCoV-19/Brazil/SP-%07d/2021|EPI_ISL_%07d|2021-03-05' % (i, i)
+            sequence = ''.join(rng.choices('ACGT', k=rng.randrange(length // 2, length * 3 // 2)))
+            outfile.write('>' + header + '\n' + '\n'.join(sequence[p:p + 60] for p in range(0, len(sequence), 60)) + '\n')
+            headers.append(header)
+    return headers
+
+
+def run_filter(scripts, script, workdir, action, output):
+    """ Run a filtering script on the synthetic files, returning its running time in seconds """
+    command = [sys.executable, os.path.join(scripts, script), '--input', 'input.fasta', '--format', 'fasta',
+               '--action', action, '--list', 'targets.txt', '--output', output]
+    start = time.perf_counter()
+    process = subprocess.run(command, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    elapsed = time.perf_counter() - start
+    if process.returncode != 0:
+        print(process.stderr)
+        raise SystemExit(script + ' failed (' + action + ')')
+    return elapsed
+
+
+def count_records(fasta):
+    with open(fasta) as infile:
+        return sum(1 for line in infile if line.startswith('>'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Time FASTA keep/remove filtering of masterkey.py and seqtree_handler.py on synthetic data",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--records", required=False, type=int, default=500000, help="Number of synthetic FASTA records")
+    parser.add_argument("--targets", required=False, type=int, default=50000, help="Number of target headers sampled from the records")
+    parser.add_argument("--length", required=False, type=int, default=200, help="Average sequence length")
+    parser.add_argument("--seed", required=False, type=int, default=7, help="Seed of the synthetic sequences and targets")
+    parser.add_argument("--scripts", required=False, type=str, default=SCRIPTS, help="Directory of the scripts to be timed")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        print('Generating ' + str(args.records) + ' records and ' + str(args.targets) + ' targets...')
+        headers = make_fasta(os.path.join(workdir, 'input.fasta'), args.records, args.length, args.seed)
+        targets = random.Random(args.seed).sample(headers, args.targets)
+        with open(os.path.join(workdir, 'targets.txt'), 'w') as outfile:
+            outfile.write(''.join(target + '\n' for target in targets))
+
+        runs = [('masterkey.py', 'keep', 'keep.fasta', 'masterkey.py keep (building the index)'),
+                ('masterkey.py', 'keep', 'keep.fasta', 'masterkey.py keep (reusing the index)'),
+                ('masterkey.py', 'remove', 'remove_masterkey.fasta', 'masterkey.py remove'),
+                ('seqtree_handler.py', 'remove', 'remove_seqtree.fasta', 'seqtree_handler.py remove')]
+        expected = {'keep': args.targets, 'remove': args.records - args.targets}
+
+        errors = []
+        print('\nRunning time:')
+        for script, action, output, name in runs:
+            elapsed = run_filter(os.path.abspath(args.scripts), script, workdir, action, output)
+            print('\t- ' + name + ': ' + '%.2f' % elapsed + ' s')
+            if count_records(os.path.join(workdir, output)) != expected[action]:
+                errors.append(name + ' did not export ' + str(expected[action]) + ' records')
+
+        if open(os.path.join(workdir, 'remove_masterkey.fasta')).read() != open(os.path.join(workdir, 'remove_seqtree.fasta')).read():
+            errors.append('outputs of masterkey.py and seqtree_handler.py remove differ')
+
+    if len(errors) > 0:
+        print('\nFAILED:')
+        for error in errors:
+            print('\t- ' + error)
+        sys.exit(1)
+    print('\nAll checks passed.\n')
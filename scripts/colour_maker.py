@@ -6,15 +6,105 @@
 
 import pandas as pd
 import argparse
-from bs4 import BeautifulSoup as BS
+import os
 import numpy as np
-from pylab import *
-from colour import Color
+import matplotlib
+import matplotlib.cm
+from functools import lru_cache
 
 import warnings
 # warnings.simplefilter(action='ignore', category=FutureWarning)
 # warnings.simplefilter(action='ignore', category=pd.errors.PerformanceWarning)
 
+
+''' PALETTE ENGINE '''
+
+# Gradients are interpolated in HSL space, reproducing the arithmetic of colour.Color.range_to and
+# Color.hex_l (colour package), and colormap colours reproduce matplotlib.colors.rgb2hex, so that
+# palettes are identical to the ones generated with those packages.
+FLOAT_ERROR = 0.0000005
+HEX_BYTES = np.array(['%02x' % i for i in range(256)], dtype=object)
+
+
+def hex_to_hsl(hex_colour):
+    """ HSL tuple of a '#rrggbb' colour, as in colour.rgb2hsl """
+    r, g, b = [float(int(hex_colour[i:i + 2], 16)) / 255 for i in (1, 3, 5)]
+    vmin = min(r, g, b)
+    vmax = max(r, g, b)
+    diff = vmax - vmin
+    vsum = vmin + vmax
+    l = vsum / 2
+    if diff < FLOAT_ERROR:  # grey
+        return 0.0, 0.0, l
+
+    if l < 0.5:
+        s = diff / vsum
+    else:
+        s = diff / (2.0 - vsum)
+    dr = (((vmax - r) / 6) + (diff / 2)) / diff
+    dg = (((vmax - g) / 6) + (diff / 2)) / diff
+    db = (((vmax - b) / 6) + (diff / 2)) / diff
+    if r == vmax:
+        h = db - dg
+    elif g == vmax:
+        h = (1.0 / 3) + dr - db
+    else:
+        h = (2.0 / 3) + dg - dr
+    if h < 0: h += 1
+    if h > 1: h -= 1
+    return h, s, l
+
+
+def hue_to_channel(v1, v2, vh):
+    """ One RGB channel from HSL components, for arrays of colours, as in colour._hue2rgb """
+    vh = vh.copy()
+    while (vh < 0).any():
+        vh[vh < 0] += 1
+    while (vh > 1).any():
+        vh[vh > 1] -= 1
+    return np.select([6 * vh < 1, 2 * vh < 1, 3 * vh < 2],
+                     [v1 + (v2 - v1) * 6 * vh, v2, v1 + (v2 - v1) * ((2.0 / 3) - vh) * 6],
+                     default=v1)
+
+
+def rgb_to_hex(rgb):
+    """ '#rrggbb' strings of an array of RGB floats, given the rounding of each channel into 0-255 integers """
+    codes = HEX_BYTES[rgb]
+    return ['#' + r + g + b for r, g, b in codes]
+
+
+@lru_cache(maxsize=None)
+def linear_gradient(start_hex, finish_hex, n):
+    """ n colours between two hex colours, interpolated in HSL space """
+    begin = np.array(hex_to_hsl(start_hex))
+    end = np.array(hex_to_hsl(finish_hex))
+    steps = n - 1
+    step = (end - begin) / steps if steps > 0 else np.zeros(3)
+    hsl = begin + step * np.arange(n)[:, None]
+    h, s, l = hsl[:, 0], hsl[:, 1], hsl[:, 2]
+
+    v2 = np.where(l < 0.5, l * (1.0 + s), (l + s) - (s * l))
+    v1 = 2.0 * l - v2
+    rgb = np.stack([hue_to_channel(v1, v2, h + (1.0 / 3)), hue_to_channel(v1, v2, h), hue_to_channel(v1, v2, h - (1.0 / 3))], axis=1)
+    rgb[s == 0] = l[s == 0, None]  # greys
+    return tuple(rgb_to_hex((rgb * 255 + 0.5 - FLOAT_ERROR).astype(int)))
+
+
+def get_cmap(name, n):
+    # matplotlib.cm.get_cmap was removed in matplotlib 3.9, and colormaps[].resampled added in 3.6
+    try:
+        return matplotlib.colormaps[name].resampled(n)
+    except AttributeError:
+        return matplotlib.cm.get_cmap(name, n)
+
+
+@lru_cache(maxsize=None)
+def colormap_colours(name, n):
+    """ All colours of a matplotlib colormap resampled into n colours """
+    rgba = get_cmap(name, n)(np.arange(n))
+    return tuple(rgb_to_hex(np.round(rgba[:, :3] * 255).astype(int)))
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description="Collapse groups of two or more rows, summing up corresponding values in matrix",
@@ -22,13 +112,17 @@ if __name__ == '__main__':
     )
     parser.add_argument("--input", required=True, help="TSV file with categorical data to be assigned with colours")
     parser.add_argument("--colours", required=True, help="TSV file with the highest level category names and their assigned hue numbers (from 0 to 350), or matplotlib colormap names")
-    parser.add_argument("--levels", required=True, nargs='+', type=str, help="List of column names with categorical data, in hierarchical order.")
+    parser.add_argument("--levels", required=True, nargs='+', type=str, action='append',
+                        help="List of column names with categorical data, in hierarchical order. "
+                             "Repeat this option to colour independent hierarchies (e.g. hosts and places) in one run")
+    parser.add_argument("--cache", required=False, help="TSV file with colours assigned in previous runs, kept for categories whose group and hue are unchanged")
     parser.add_argument("--output", required=True, help="Final output with colour schemes in TSV format")
     args = parser.parse_args()
 
     input = args.input
     colours = args.colours
-    levels = args.levels
+    level_groups = args.levels
+    cache = args.cache
     output = args.output
 
 
@@ -67,7 +161,6 @@ if __name__ == '__main__':
     # open dataframe
     df = load_table(input)
     df.fillna('', inplace=True)
-    df = df[~df[levels[0]].isin([''])]
 
     dfC = load_table(colours)
     colour_wheel= {}
@@ -78,16 +171,15 @@ if __name__ == '__main__':
 
     # print(colour_wheel)
 
-    ''' GENERATE COLOUR SCHEME '''
-
-    def linear_gradient(start_hex, finish_hex, n):
-        start = Color(start_hex)
-        end = Color(finish_hex)
-        colors = list(start.range_to(end, n))
-        colors = [c.hex_l for c in colors]
-        # print(colors)
-        return colors
+    # colours assigned in previous runs: (field, value) > (hex colour, highest category, hue)
+    cached = {}
+    if cache not in ['', None] and os.path.isfile(cache):
+        for line in open(cache, encoding='utf-8').readlines()[1:]:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) == 5:
+                cached[(fields[0], fields[1])] = tuple(fields[2:])
 
+    ''' GENERATE COLOUR SCHEME '''
 
     hue_to_hex = {
         0: ('#660000', '#F5D6D6'), 10: ('#661100', '#F5DBD6'), 20: ('#662200', '#F5E0D6'),
@@ -106,49 +198,79 @@ if __name__ == '__main__':
     # print(hue_to_hex)
 
 
-    # # output dictionary
-    results = {trait: {} for trait in levels}
-    for highest, dfG in df[levels].groupby(levels[0], as_index=False):
-        # print('\n' + highest)
-        dfG = dfG.drop_duplicates().sort_values(by=levels)
-        # print(dfG)
-        for level in levels:
-            members = dfG[level].drop_duplicates().tolist()
-
-            if colour_wheel[highest].isdigit():
-                start, end = hue_to_hex[int(colour_wheel[highest])]
-                # print(highest, len(members))
-                if len(members) == 1:
-                    gradient = linear_gradient(start, end, 11)
-                    gradient = [list(gradient)[3]]
-                elif 1 < len(members) < 5:
-                    gradient = linear_gradient(start, end, 11)
-                    if len(members) == 2:
-                        gradient = [list(gradient)[2], list(gradient)[8]]
-                    elif len(members) == 3:
-                        gradient = [list(gradient)[1], list(gradient)[5], list(gradient)[9]]
-                    else:
-                        gradient = [list(gradient)[0], list(gradient)[3], list(gradient)[6], list(gradient)[9]]
+    def palette(highest, size):
+        """ Colours of a group with 'size' members, from its hue or matplotlib colormap """
+        if colour_wheel[highest].isdigit():
+            start, end = hue_to_hex[int(colour_wheel[highest])]
+            # print(highest, size)
+            if size == 1:
+                gradient = linear_gradient(start, end, 11)
+                gradient = [list(gradient)[3]]
+            elif 1 < size < 5:
+                gradient = linear_gradient(start, end, 11)
+                if size == 2:
+                    gradient = [list(gradient)[2], list(gradient)[8]]
+                elif size == 3:
+                    gradient = [list(gradient)[1], list(gradient)[5], list(gradient)[9]]
                 else:
-                    gradient = linear_gradient(start, end, len(members))
-                for memb, colour in zip(members, gradient):
-                    # print(level, memb, colour)
-                    results[level].update({memb: colour})
+                    gradient = [list(gradient)[0], list(gradient)[3], list(gradient)[6], list(gradient)[9]]
             else:
-                if len(members) == 1:
-                    memb = members[0]
-                    cmap = cm.get_cmap(colour_wheel[highest], 11)
-                    rgba = cmap(5)
-                    colour = matplotlib.colors.rgb2hex(rgba)
-                    # print(level, memb, colour)
-                    results[level].update({memb: colour})
+                gradient = linear_gradient(start, end, size)
+        else:
+            if size == 1:
+                gradient = [colormap_colours(colour_wheel[highest], 11)[5]]
+            else:
+                gradient = colormap_colours(colour_wheel[highest], size + 4)[2:-2]
+        return [colour.upper() for colour in gradient]
+
+
+    def colour_scheme(df, levels):
+        # # output dictionary
+        results = {trait: {} for trait in levels}
+
+        df = df[~df[levels[0]].isin([''])]
+        for highest, dfG in df[levels].groupby(levels[0], as_index=False):
+            # print('\n' + highest)
+            dfG = dfG.drop_duplicates().sort_values(by=levels)
+            # print(dfG)
+            for level in levels:
+                members = dfG[level].drop_duplicates().tolist()
+
+                # colours of previous runs are kept for members still in the same group, with the same hue
+                kept = {}
+                for memb in members:
+                    entry = cached.get((level, memb))
+                    if entry is not None and entry[1:] == (highest, colour_wheel[highest]):
+                        kept[memb] = entry[0]
+
+                # new palettes are only needed if there are new members, members that changed groups,
+                # or kept colours that are not unique (e.g. in caches of older versions)
+                unique = len(set(kept.values())) == len(kept)
+                if len(kept) == len(members) and unique:
+                    colours = kept
                 else:
-                    cmap = cm.get_cmap(colour_wheel[highest], len(members)+4)
-                    for i, memb in zip(range(cmap.N)[2:-2], members):
-                        rgba = cmap(i)
-                        colour = matplotlib.colors.rgb2hex(rgba)
-                        # print(level, memb, colour)
-                        results[level].update({memb: colour})
+                    gradient = palette(highest, len(members))
+                    # new members take colours not used by kept members; if there are not enough of them,
+                    # or kept colours are not unique, the whole group is coloured again
+                    new_members = [memb for memb in members if memb not in kept]
+                    free = [colour for colour in gradient if colour not in set(kept.values())]
+                    if len(free) >= len(new_members) and unique:
+                        colours = dict(kept)
+                        colours.update(zip(new_members, free))
+                    else:
+                        colours = dict(zip(members, gradient))
+                if len(set(colours.values())) < len(members):
+                    print('\t* WARNING! Some categories share colours in ' + highest + ' (' + level + ')')
+
+                for memb in members:
+                    # print(level, memb, colours[memb])
+                    results[level].update({memb: colours[memb]})
+                    cached[(level, memb)] = (colours[memb], highest, colour_wheel[highest])
+        return results
+
+
+    # colour each hierarchy of levels independently
+    schemes = [colour_scheme(df, levels) for levels in level_groups]
 
 
     ''' EXPORT COLOUR FILE '''
@@ -156,9 +278,16 @@ if __name__ == '__main__':
     with open(output, 'w') as outfile:
         header = "{}\t{}\t{}\n".format('field', 'value', 'hex_color')
         outfile.write(header)
-        for trait, entries in results.items():
-            for place, hexcolour in entries.items():
-                line = "{}\t{}\t{}\n".format(trait, place, hexcolour.upper())
-                outfile.write(line)
-            outfile.write('\n')
+        for results in schemes:
+            for trait, entries in results.items():
+                for place, hexcolour in entries.items():
+                    line = "{}\t{}\t{}\n".format(trait, place, hexcolour.upper())
+                    outfile.write(line)
+
+    # save all colours assigned so far, including categories absent from this run
+    if cache not in ['', None]:
+        with open(cache, 'w', encoding='utf-8') as outfile:
+            outfile.write('field\tvalue\thex_color\tgroup\thue\n')
+            for (trait, value), entry in cached.items():
+                outfile.write('\t'.join((trait, value) + entry) + '\n')
     print('\nColour file successfully created!\n')
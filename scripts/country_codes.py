@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+"""
+Country name to ISO 3166 code resolution, shared by the metadata processing scripts.
+
+Names are resolved in this order:
+    1. pycountry_convert exact name lookup
+    2. accent-, case- and punctuation-insensitive index of pycountry and pycountry_convert names
+    3. TSV cache of previous fuzzy searches (including failed ones), reused across runs
+    4. pycountry.countries.search_fuzzy, whose result is saved in the cache
+"""
+
+import os
+import unicodedata
+import pycountry_convert as pyCountry
+import pycountry
+
+
+def fold_name(name):
+    """ Normalize a place name for comparisons: 'Côte d'Ivoire' > 'cotedivoire' """
+    name = unicodedata.normalize('NFKD', str(name))
+    return ''.join(c for c in name if c.isalnum()).casefold()
+
+
+class CountryCodes:
+    def __init__(self, cache=None):
+        self.cache = cache
+        self.isos = {'': ''}  # resolved names, in this run
+        self.subdivisions = {}
+
+        # index of known country names, with their alpha3 codes
+        self.index = {}
+        for name, alpha3 in pyCountry.map_country_name_to_country_alpha3().items():
+            self.index.setdefault(fold_name(name), alpha3)
+        for country in pycountry.countries:
+            for field in ['name', 'official_name', 'common_name', 'alpha_3']:
+                if hasattr(country, field):
+                    self.index.setdefault(fold_name(getattr(country, field)), country.alpha_3)
+
+        # results of fuzzy searches from previous runs
+        self.fuzzy = {}
+        self.new_searches = 0
+        if cache not in ['', None] and os.path.isfile(cache):
+            for line in open(cache, encoding='utf-8').readlines():
+                if not line.startswith('#') and '\t' in line:
+                    name, code = line.rstrip('\n').split('\t')[:2]
+                    self.fuzzy[name] = code
+
+    def alpha3(self, country):
+        """ ISO alpha3 code of a country name, or '' if not found """
+        if country not in self.isos:
+            try:
+                code = pyCountry.country_name_to_country_alpha3(country, cn_name_format="default")
+            except Exception:
+                code = self.index.get(fold_name(country))
+                if code is None:
+                    code = self.search_fuzzy(country)
+            self.isos[country] = code
+        return self.isos[country]
+
+    def alpha2(self, country):
+        """ ISO alpha2 code of a country name, or '' if not found """
+        try:
+            return pyCountry.country_name_to_country_alpha2(country, cn_name_format="default")
+        except Exception:
+            alpha3 = self.alpha3(country)
+            if alpha3 == '':
+                return ''
+            return pycountry.countries.get(alpha_3=alpha3).alpha_2
+
+    def subdivision(self, country, code):
+        """ Name of a subdivision (e.g. a state) given its country and code, or None if not found """
+        key = country + '-' + code
+        if key not in self.subdivisions:
+            try:
+                result = pycountry.subdivisions.get(code=self.alpha2(country) + '-' + code).name
+            except Exception:
+                result = None
+            self.subdivisions[key] = result
+        return self.subdivisions[key]
+
+    def search_fuzzy(self, country):
+        if country not in self.fuzzy:
+            try:
+                code = pycountry.countries.search_fuzzy(country)[0].alpha_3
+            except Exception:
+                code = ''
+            self.fuzzy[country] = code
+            self.new_searches += 1
+        return self.fuzzy[country]
+
+    def save(self):
+        """ Export fuzzy search results to the cache file, if new searches were done """
+        if self.cache in ['', None] or self.new_searches == 0:
+            return
+        with open(self.cache, 'w', encoding='utf-8') as outfile:
+            outfile.write('# country name\tISO alpha3 code\n')
+            for name, code in sorted(self.fuzzy.items()):
+                outfile.write(name + '\t' + code + '\n')
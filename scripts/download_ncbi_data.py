@@ -1,16 +1,217 @@
 # -*- coding: utf-8 -*-
 
-from Bio import Entrez
 from Bio import SeqIO
+from io import StringIO
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import gzip
 import time
-import numpy as np
 import argparse
 import pandas as pd
-import pycountry_convert as pcc
-import pycountry
+from country_codes import CountryCodes
+from eutils import Eutils, EUTILS_URL
+from fasta_index import iter_headers
 import os
 
-Entrez.email = "youremail@email.com"
+NCBI_EMAIL = "youremail@email.com"  # add your email here
+METADATA_COLUMNS = ['id', 'genbank', 'date', 'country', 'division', 'location', 'length', 'host', 'authors', 'date_submitted']
+CHECKPOINT_SUFFIX = '.checkpoint'
+
+
+def fasta_accession(header):
+    """ Accession number in a FASTA header: 'hCoV-19/XX123456 | 2021-01-01' > 'XX123456' """
+    return header.replace('hCoV-19/', '').split('|')[0].replace(' ', '').strip()
+
+
+def genbank_metadata(seq_record, code2name):
+    """ Metadata row of a GenBank record """
+    accno = seq_record.id.split('.')[0]
+    genome, genbank, date, country, division, location, length, host, authors, date_submitted = ['' for x in range(10)]
+    for feature in seq_record.annotations['references']:
+        length = str(len(seq_record.seq))
+        authors = feature.authors.split(",")[0] + " et al"
+        if feature.title =='Direct Submission':
+            date_submitted = pd.to_datetime(feature.journal.split('(')[1].split(')')[0]).strftime('%Y-%m-%d')
+            # print(date_submitted)
+
+    for feature in seq_record.features:
+        if feature.type == 'source':
+            try:
+                date = feature.qualifiers['collection_date'][0]
+                # print(date)
+                if len(date) > 7:
+                    date = pd.to_datetime(date).strftime('%Y-%m-%d')
+                elif len(date) == 4:
+                    date = date + '-XX-XX'
+                elif len(date) == 7:
+                    date = date + '-XX'
+            except:
+                pass
+            try:
+                origin = feature.qualifiers['country'][0]
+                if ':' in origin:
+                    country = origin.split(":")[0]
+                    if len(origin.split(":")) > 0:  # get subnational location information
+                        subnational = origin.split(":")[1]
+                        if ',' in subnational:
+                            division = subnational.split(',')[0].strip()
+                            location = subnational.split(',')[1].strip()
+                        else:
+                            division = subnational.strip()
+                else:
+                    country = origin
+            except:
+                pass
+            try:
+                if len(division) == 2:
+                    division = code2name(country, division)
+            except:
+                pass
+            try:
+                host = feature.qualifiers['host'][0]
+            except:
+                pass
+
+    return {'id': accno, 'genbank': accno, 'date': date, 'country': country, 'division': division,
+            'location': location, 'length': length, 'host': host, 'authors': authors,
+            'date_submitted': date_submitted}
+
+
+def unresolved_subdivision(country, code):
+    """ Subdivision resolver of worker processes: codes are kept as found, and resolved by the main process """
+    raise KeyError('Subdivision not resolved: ' + country + '-' + code)
+
+
+def parse_genbank(task):
+    """ Sequences and metadata rows of the records in a GenBank text: list of (accno, length, sequence, metadata, error) """
+    text, get_sequences, get_metadata = task
+    results = []
+    for seq_record in SeqIO.parse(StringIO(text), "gb"):
+        accno = seq_record.id.split('.')[0]
+        sequence, data, error = None, None, None
+        try:
+            if get_sequences == 'yes':
+                sequence = str(seq_record.seq) # genome sequence
+            if get_metadata == 'yes':
+                data = genbank_metadata(seq_record, unresolved_subdivision)
+        except Exception as parsing_error:
+            error = str(parsing_error)
+        results.append((accno, len(seq_record), sequence, data, error))
+    return results
+
+
+def read_genbank_chunks(files, chunk_size=200):
+    """ Yield texts with up to 'chunk_size' records from GenBank flatfiles, gzipped or not """
+    for file in files:
+        opener = gzip.open if file.endswith('.gz') else open
+        with opener(file, 'rt', encoding='utf-8') as infile:
+            lines, records = [], 0
+            for line in infile:
+                lines.append(line)
+                if line.startswith('//'):
+                    records += 1
+                    if records == chunk_size:
+                        yield ''.join(lines)
+                        lines, records = [], 0
+            end = len(lines)  # lines after the last complete record
+            while end > 0 and not lines[end - 1].startswith('//'):
+                end -= 1
+            if records > 0:
+                yield ''.join(lines[:end])
+            if ''.join(lines[end:]).strip() != '':
+                print('\t- WARNING! Incomplete record at the end of ' + file + ', skipping it')
+
+
+def parse_gbff(files, get_sequences, get_metadata, threads=1, chunk_size=200):
+    """ Yield parsed chunks of GenBank flatfiles, in order, parsing up to two chunks per process at a time """
+    tasks = ((text, get_sequences, get_metadata) for text in read_genbank_chunks(files, chunk_size))
+    if threads <= 1:
+        for task in tasks:
+            yield parse_genbank(task)
+        return
+
+    with ProcessPoolExecutor(max_workers=threads) as executor:
+        pending = deque()
+        for task in tasks:
+            pending.append(executor.submit(parse_genbank, task))
+            if len(pending) >= 2 * threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class MetadataWriter:
+    """ Append-only TSV writer, keeping rows in memory and writing them in batches.
+    The file is only created (or opened for appending) when the first rows are written """
+
+    def __init__(self, path, columns, append=False, batch_size=1000):
+        self.path = path
+        self.columns = list(columns)
+        self.append = append
+        self.batch_size = batch_size
+        self.rows = []
+        self.outfile = None
+        self.writer = None
+
+    def _open(self):
+        if self.append and os.path.isfile(self.path) and os.path.getsize(self.path) > 0:
+            with open(self.path, encoding='utf-8', newline='') as infile:
+                header = next(csv.reader(infile, delimiter='\t'))
+            missing = [column for column in self.columns if column not in header]
+            if len(missing) > 0:  # new columns: existing rows are rewritten once, with blank values
+                df = pd.read_csv(self.path, encoding='utf-8', sep='\t', dtype=str)
+                df.reindex(columns=header + missing).to_csv(self.path, sep='\t', index=False)
+            self.columns = header + missing
+            with open(self.path, 'rb') as infile:
+                infile.seek(-1, os.SEEK_END)
+                complete = infile.read(1) == b'\n'
+            self.outfile = open(self.path, 'a', encoding='utf-8', newline='')
+            if not complete:
+                self.outfile.write('\n')
+            self.writer = csv.DictWriter(self.outfile, fieldnames=self.columns, delimiter='\t', lineterminator='\n', restval='', extrasaction='ignore')
+        else:
+            self.outfile = open(self.path, 'w', encoding='utf-8', newline='')
+            self.writer = csv.DictWriter(self.outfile, fieldnames=self.columns, delimiter='\t', lineterminator='\n', restval='', extrasaction='ignore')
+            self.writer.writeheader()
+
+    def write(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.rows) > 0:
+            if self.outfile is None:
+                self._open()
+            self.writer.writerows(self.rows)
+            self.rows = []
+        if self.outfile is not None:
+            self.outfile.flush()
+
+    def close(self):
+        self.flush()
+        if self.outfile is not None:
+            self.outfile.close()
+            self.outfile = None
+
+
+def read_checkpoint(checkpoint):
+    """ Search query and next esearch offset saved by an interrupted run """
+    values = {}
+    if os.path.isfile(checkpoint):
+        for line in open(checkpoint, encoding='utf-8').readlines():
+            if '\t' in line:
+                key, value = line.rstrip('\n').split('\t', 1)
+                values[key] = value
+    return values
+
+
+def write_checkpoint(checkpoint, query, offset, total):
+    with open(checkpoint + '.tmp', 'w', encoding='utf-8') as outfile:
+        outfile.write('query\t' + query + '\noffset\t' + str(offset) + '\ntotal\t' + str(total) + '\n')
+    os.replace(checkpoint + '.tmp', checkpoint)
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -19,7 +220,7 @@ if __name__ == '__main__':
     )
     parser.add_argument("--fasta", required=False, help="Existing FASTA file with previously downloaded sequences")
     parser.add_argument("--metadata", required=False, help="Existing TSV metadata file generated previouly by this script")
-    parser.add_argument("--taxid", required=True, type=int, help="NCBI Taxonomy ID (e.g. Dengue virus 2 = 11060)")
+    parser.add_argument("--taxid", required=False, type=int, help="NCBI Taxonomy ID (e.g. Dengue virus 2 = 11060). Required unless --from-gbff is used")
     parser.add_argument("--genome-size", required=True, type=int, help="Reference genome size (in nucleotides")
     parser.add_argument("--min-size", required=False, type=str, help="Minimum genome size (in nucleotides or proportion as float)")
     parser.add_argument("--max-size", required=False, type=str, help="Maximum genome size (in nucleotides or proportion as float)")
@@ -29,10 +230,24 @@ if __name__ == '__main__':
                         choices=['yes', 'no'], help="Should metadata be downloaded in this run: yes or no?")
     parser.add_argument("--mode", required=False, nargs=1, type=str,  default='mock', choices=['separate', 'append', 'mock'],
                         help="How the output will be exported? As a separate file, or appending to an existing file?")
+    parser.add_argument("--iso-cache", required=False, help="TSV file caching ISO codes of country names found by fuzzy searches")
+    parser.add_argument("--batch-size", required=False, type=int, default=500, help="Number of GenBank records downloaded per request")
+    parser.add_argument("--page-size", required=False, type=int, default=5000, help="Number of search results inspected per cycle")
+    parser.add_argument("--workers", required=False, type=int, default=3, help="Number of batches downloaded concurrently, within NCBI's rate limit")
+    parser.add_argument("--retries", required=False, type=int, default=5, help="Number of retries of failed requests, with exponential backoff")
+    parser.add_argument("--api-key", required=False, default=os.environ.get('NCBI_API_KEY'), help="NCBI API key, raising the rate limit from 3 to 10 requests per second")
+    parser.add_argument("--eutils-url", required=False, default=EUTILS_URL, help="Base URL of NCBI E-utilities")
+    parser.add_argument("--resume", required=False, action='store_true',
+                        help="Continue an interrupted run from its checkpoint file, appending to its output files")
+    parser.add_argument("--from-gbff", required=False, nargs='+',
+                        help="Import records from local GenBank flatfiles (.gb, .gbff, or gzipped), such as NCBI Virus downloads, instead of searching NCBI")
+    parser.add_argument("--threads", required=False, type=int, default=1, help="Number of processes used to parse GenBank flatfiles")
     parser.add_argument("--output1", required=False, help="Output fasta file")
     parser.add_argument("--output2", required=False, help="Output TSV metadata file")
 
     args = parser.parse_args()
+    if args.taxid is None and args.from_gbff is None:
+        parser.error('--taxid is required, unless records are imported with --from-gbff')
     sequences = args.fasta
     metadata = args.metadata
     txid = str(args.taxid)
@@ -44,6 +259,12 @@ if __name__ == '__main__':
     how = args.mode[0]
     output1 = args.output1
     output2 = args.output2
+    iso_cache = args.iso_cache
+    batch_size = args.batch_size
+    page_size = args.page_size
+    resume = args.resume
+    gbff_files = args.from_gbff
+    threads = args.threads
 
 
     # path = '/Users/Anderson/Library/CloudStorage/GoogleDrive-anderson.brito@itps.org.br/Outros computadores/My Mac mini/google_drive/ITpS/projetos_colaboracoes/nextstrain/pipeline/flexpipe/data/'
@@ -96,41 +317,56 @@ if __name__ == '__main__':
 
 
     # existing ncbi fasta file
-    existing_sequences = []
+    existing_sequences = set()
     if sequences != None:
-        cmd = 'grep \"^>\" \"' + sequences + '\" | sed \'s/>//g\' > seqlist.txt'
-        os.system(cmd)
-        existing_sequences = list(set([header.replace('hCoV-19/', '').split('|')[0].replace(' ', '').strip() for header in open('seqlist.txt').readlines()]))
-        os.system('rm seqlist.txt')
+        existing_sequences = set(fasta_accession(header) for header in iter_headers(sequences))
 
 
-    dfR = pd.DataFrame(columns=['genbank'])
+    # existing metadata file: only accession numbers are needed
+    existing_metadata = set()
     if metadata != None:
-        dfR = pd.read_csv(metadata, encoding='utf-8', sep='\t', dtype=str)
+        existing_metadata = set(pd.read_csv(metadata, encoding='utf-8', sep='\t', dtype=str, usecols=['genbank'])['genbank'].dropna())
+
+    # outputs of an interrupted run: their entries are not downloaded again
+    if resume and how == 'separate':
+        if os.path.isfile(output1):
+            existing_sequences.update(fasta_accession(header) for header in iter_headers(output1))
+        if os.path.isfile(output2):
+            existing_metadata.update(pd.read_csv(output2, encoding='utf-8', sep='\t', dtype=str, usecols=['genbank'])['genbank'].dropna())
 
 
     # print(txid, min, max)
     # inspect = Entrez.esearch(db="nucleotide", term="txid2697049[Organism] 25000:35000[SLEN]", idtype="acc")
-    query = "txid%s[Organism] %s:%s[SLEN]" % (txid, min, max)
-    inspect = Entrez.esearch(db="nucleotide", term=query, idtype="acc")
-    total_entries = int(Entrez.read(inspect)['Count'])
-    # print(total_entries)
+    if gbff_files is None:
+        client = Eutils(args.eutils_url, email=NCBI_EMAIL, api_key=args.api_key, retries=args.retries)
+        query = "txid%s[Organism] %s:%s[SLEN]" % (txid, min, max)
+        total_entries, search = client.esearch('nucleotide', query)
+        # print(total_entries)
+
+    # checkpoint of the last esearch offset processed, in runs exporting files
+    checkpoint = None
+    first_entry = 0
+    if how in ['separate', 'append'] and gbff_files is None:
+        checkpoint = (output2 if output2 not in [None, ''] else output1) + CHECKPOINT_SUFFIX
+        if resume:
+            saved = read_checkpoint(checkpoint)
+            if saved.get('query') == query:
+                first_entry = int(saved['offset'])
+                print('\nResuming from entry ' + str(first_entry + 1) + ' of ' + str(total_entries))
+            elif len(saved) > 0:
+                print('\nCheckpoint was saved for a different search (' + saved.get('query', '') + '). Starting from the first entry.')
 
     # convert state code to name
-    state_names = {}
+    country_resolver = CountryCodes(iso_cache)
     def code2name(country, accronym):
-        if country + '-' + accronym not in state_names:
-            alpha2 = pcc.country_name_to_country_alpha2(country, cn_name_format="default")
-            query = alpha2 + '-' + accronym
-            result = pycountry.subdivisions.get(code=query).name
-            state_names[country + '-' + accronym] = result
-            return result
-        else:
-            return state_names[country + '-' + accronym]
+        result = country_resolver.subdivision(country, accronym)
+        if result is None:
+            raise KeyError('Subdivision not found: ' + country + '-' + accronym)
+        return result
 
     # open output file
     if how == 'separate': # save in a separate file
-        outfile1 = open(output1, 'w')
+        outfile1 = open(output1, 'a' if resume else 'w')
         outfile1.write('')
 
     elif how == 'append':
@@ -143,7 +379,6 @@ if __name__ == '__main__':
 
     ### START NCBI SEARCH
 
-    start_at = 1
     notFound = []
     today = time.strftime('%Y-%m-%d', time.gmtime())
 
@@ -151,152 +386,117 @@ if __name__ == '__main__':
     # skip_extra = open(skip, 'a')
     comment = ''
 
-    dfM = pd.DataFrame()
-    if total_entries > 1000:
-        c = 1
-        for num in range(1, int(np.ceil(total_entries/1000)) + 1):
+    # metadata rows are appended to the output file, or to the existing metadata file in append mode
+    metadata_writer = None
+    if output2 not in [None, '']:
+        metadata_writer = MetadataWriter(output2, METADATA_COLUMNS, append=(how == 'append' or resume))
+
+    def export(accno, sequence, data, error):
+        """ Export the sequence and metadata of a parsed record, unless already present """
+        if sequence is not None:
+            if accno not in existing_sequences: # avoiding duplicates
+                if how in ['separate', 'append']:
+                    outfile1.write('>' + accno + '\n' + sequence + '\n')
+                existing_sequences.add(accno)
+                print('\t- ' + accno + ': exporting NCBI fasta')
+            else:
+                print('\t- ' + accno + ': genome already downloaded. Skipping... ')
+
+        if data is not None:
+            if accno not in existing_metadata: # avoiding duplicates
+                if len(data['division']) == 2:
+                    try:
+                        data['division'] = code2name(data['country'], data['division'])
+                    except:
+                        pass
+                if metadata_writer is not None:
+                    metadata_writer.write(data)
+                existing_metadata.add(accno)
+                print('\t- ' + accno + ': ' + 'exporting NCBI metadata')
+            else:
+                print('\t- ' + accno + ': metadata already downloaded. Skipping... ')
+
+        if error is not None:
+            print("\t- " + accno + ": entry not found on NCBI, or backend searching failed")
+            notFound.append(accno)
+
+    def flush():
+        if how in ['separate', 'append']:
+            outfile1.flush()
+        if metadata_writer is not None:
+            metadata_writer.flush()
+
+    c = first_entry + 1
+    if gbff_files is not None:
+        # import records from local GenBank flatfiles, keeping those within the genome size range
+        print('\nImporting records from ' + str(len(gbff_files)) + ' GenBank flatfile(s), using ' + str(threads) + ' process(es)')
+        out_of_range = 0
+        for results in parse_gbff(gbff_files, get_sequences, get_metadata, threads=threads):
+            for accno, length, sequence, data, error in results:
+                if not float(min) <= length <= float(max):
+                    out_of_range += 1
+                    continue
+                print('\n' + str(c))
+                export(accno, sequence, data, error)
+                c += 1
+            flush()
+        if out_of_range > 0:
+            print('\nA total of ' + str(out_of_range) + ' records were outside the genome size range, and were skipped.')
+
+    else:
+        # search NCBI, and download new entries
+        for num, start_at in enumerate(range(first_entry, total_entries, page_size), start=first_entry // page_size + 1):
             print('\n>>> Retrieving cycle ' + str(num))
-            handle = Entrez.esearch(db="nucleotide", retstart=start_at, retmax=1000,
-                                    term=query, idtype="acc")
-            record = Entrez.read(handle)
-            start_at = num * 1000 # define the rounds of search
-
-            previous = 1
-            count = 1
-            seq_search_list = [accno.split('.')[0] for accno in record['IdList'] if accno.split('.')[0] not in existing_sequences]
+            id_list = client.accessions('nucleotide', search, start_at, page_size)  # accession.version numbers
+            versions = {accno.split('.')[0]: accno for accno in id_list}
+
+            seq_search_list = [accno.split('.')[0] for accno in id_list if accno.split('.')[0] not in existing_sequences]
             # print(seq_search_list)
 
-            met_search_list = [accno.split('.')[0] for accno in record['IdList'] if accno.split('.')[0] not in dfR['genbank'].tolist()]
+            met_search_list = [accno.split('.')[0] for accno in id_list if accno.split('.')[0] not in existing_metadata]
             # print(met_search_list)
 
-            search_list = list(set(seq_search_list + met_search_list))
+            search_list = list(dict.fromkeys(seq_search_list + met_search_list))
 
-            excluded = [accno.split('.')[0] for accno in record['IdList'] if accno.split('.')[0] not in search_list]
+            searched = set(search_list)
+            excluded = [accno.split('.')[0] for accno in id_list if accno.split('.')[0] not in searched]
             c += len(excluded)
 
             if len(excluded) > 0:
                 print('A total of ' + str(len(excluded)) + ' entries were already present in the existing datasets.')
-            for accno in search_list:#[245:250]:
-                print('\n' + str(c) + '/' + str(total_entries))
-
-                accno = accno.split('.')[0]
-                new_row = {} # to update metadata dataframe
-
-                current = time.time()
-                delay = 0.4
-                elapsed = current - previous
-                wait = delay - elapsed
-
-                try:
-
-                    handle = Entrez.efetch(db="nucleotide", id=accno, rettype="gb", retmode="text")
-                    genome, genbank, date, country, division, location, length, host, authors, date_submitted = ['' for x in range(10)]
-
-                    sequence = ''
-                    for seq_record in SeqIO.parse(handle, "gb"):
-                        if get_sequences == 'yes':
-                            sequence = str(seq_record.seq) # genome sequence
-
-                            if accno not in existing_sequences: # avoiding duplicates
-                                if how == 'separate':
-                                    outfile1.write('>' + accno + '\n' + sequence + '\n')
-                                    outfile1.flush()
-
-                                elif how == 'append':
-                                    outfile1.write('>' + accno + '\n' + sequence + '\n')
-                                    outfile1.flush()
-                                existing_sequences.append(accno)
-                                print('\t- ' + accno + ': exporting NCBI fasta')
-                            else:
-                                print('\t- ' + accno + ': genome already downloaded. Skipping... ')
-
-
-                        if get_metadata == 'yes':
-                            if accno not in dfR['genbank'].tolist(): # avoiding duplicates
-                                data = {}
-                                for feature in seq_record.annotations['references']:
-                                    length = str(len(seq_record.seq))
-                                    authors = feature.authors.split(",")[0] + " et al"
-                                    if feature.title =='Direct Submission':
-                                        date_submitted = pd.to_datetime(feature.journal.split('(')[1].split(')')[0]).strftime('%Y-%m-%d')
-                                        # print(date_submitted)
-
-                                for feature in seq_record.features:
-                                    if feature.type == 'source':
-                                        try:
-                                            date = feature.qualifiers['collection_date'][0]
-                                            # print(date)
-                                            if len(date) > 7:
-                                                date = pd.to_datetime(date).strftime('%Y-%m-%d')
-                                            elif len(date) == 4:
-                                                date = date + '-XX-XX'
-                                            elif len(date) == 7:
-                                                date = date + '-XX'
-                                        except:
-                                            pass
-                                        try:
-                                            origin = feature.qualifiers['country'][0]
-                                            if ':' in origin:
-                                                country = origin.split(":")[0]
-                                                if len(origin.split(":")) > 0:  # get subnational location information
-                                                    subnational = origin.split(":")[1]
-                                                    if ',' in subnational:
-                                                        division = subnational.split(',')[0].strip()
-                                                        location = subnational.split(',')[1].strip()
-                                                    else:
-                                                        division = subnational.strip()
-                                            else:
-                                                country = origin
-                                        except:
-                                            pass
-                                        try:
-                                            if len(division) == 2:
-                                                division = code2name(country, division)
-                                        except:
-                                            pass
-                                        try:
-                                            host = feature.qualifiers['host'][0]
-                                        except:
-                                            pass
-
-
-                                data = {'id': accno, 'genbank': accno, 'date': date, 'country': country, 'division': division,
-                                        'location': location, 'length': length, 'host': host, 'authors': authors,
-                                        'date_submitted': date_submitted}
-                                new_row.update(data)
-
-                                # create an output dataframe
-                                if len(dfR.columns.tolist()) == 1 and dfM.empty: # no existing metadata provided
-                                    dfM = pd.DataFrame(columns=list(data.keys()))
-                                else:
-                                    if dfM.empty and how == 'append': # cache metadata provided, append as output
-                                        dfM = dfR
-                                    elif dfM.empty and how == 'separate': # cache metadata provided, blank DF as output
-                                        dfM = pd.DataFrame(columns=list(data.keys()))
-
-                                # dfM = dfM.append(new_row, ignore_index=True)
-                                # print(new_row)
-
-                                new_row = {k: [v] for k, v in new_row.items()}  # WORKAROUND
-                                dfS = pd.DataFrame(new_row)
-                                frames = [dfM, dfS]
-                                dfM = pd.concat(frames).reset_index(drop=True)
-                                # print(dfM)
-                                dfM.to_csv(output2, sep='\t', index=False, header=True, mode='w')
-
-                                print('\t- ' + accno + ': ' + 'exporting NCBI metadata')
-
-                            else:
-                                print('\t- ' + accno + ': metadata already downloaded. Skipping... ')
-
-                except:
-                    print("\t- " + accno + ": entry not found on NCBI, or backend searching failed")
-                    notFound.append(accno)
-
-                previous = time.time()
-                count += 1
-                c += 1
 
+            # download GenBank records in batches, from the list of new entries posted to NCBI's history server
+            batches = client.fetch_batches('nucleotide', [versions[accno] for accno in search_list],
+                                           batch_size=batch_size, workers=args.workers)
+            for batch, text in batches:
+                retrieved = set()
+                if text is not None:
+                    for accno, length, sequence, data, error in parse_genbank((text, get_sequences, get_metadata)):
+                        retrieved.add(accno)
+                        print('\n' + str(c) + '/' + str(total_entries))
+                        export(accno, sequence, data, error)
+                        c += 1
+
+                flush()
+                for accession in batch:
+                    accno = accession.split('.')[0]
+                    if accno not in retrieved:
+                        print("\t- " + accno + ": entry not found on NCBI, or backend searching failed")
+                        notFound.append(accno)
+                        c += 1
+
+            if checkpoint is not None:
+                write_checkpoint(checkpoint, query, start_at + page_size, total_entries)
+
+    # the run is complete
+    if metadata_writer is not None:
+        metadata_writer.close()
+    if how in ['separate', 'append']:
+        outfile1.close()
+    if checkpoint is not None and os.path.isfile(checkpoint):
+        os.remove(checkpoint)
+
+    country_resolver.save()
 
     # list entries not found on NCBI
     if len(notFound) > 0:
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+"""
+Minimal NCBI E-utilities client, using the history server for large downloads.
+
+All requests share a rate limit (NCBI allows 3 requests per second, or 10 with
+an API key), and failed requests are retried with exponential backoff. The
+base URL can point to a local server mimicking E-utilities, for tests.
+"""
+
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import xml.etree.ElementTree as ET
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from rate_limit import RateLimiter
+
+EUTILS_URL = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/'
+
+
+class EutilsError(Exception):
+    pass
+
+
+class Eutils:
+    def __init__(self, base_url=EUTILS_URL, email=None, api_key=None, tool='flexpipe',
+                 rate=None, retries=5, backoff=2.0, timeout=300):
+        self.base_url = base_url.rstrip('/') + '/'
+        self.params = {'tool': tool}
+        if email not in ['', None]:
+            self.params['email'] = email
+        if api_key not in ['', None]:
+            self.params['api_key'] = api_key
+        if rate is None:
+            rate = 10 if api_key not in ['', None] else 3
+        self.limiter = RateLimiter(rate)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+    def request(self, utility, check=None, **params):
+        """ POST a request to an E-utility, retrying server errors, network errors and responses failing 'check' """
+        data = urllib.parse.urlencode(dict(self.params, **params)).encode('utf-8')
+        for attempt in range(self.retries + 1):
+            self.limiter.wait()
+            try:
+                with urllib.request.urlopen(self.base_url + utility + '.fcgi', data=data, timeout=self.timeout) as response:
+                    text = response.read().decode('utf-8')
+                if check is None or check(text):
+                    return text
+                error = EutilsError('incomplete response from ' + utility)
+            except urllib.error.HTTPError as http_error:
+                if http_error.code < 500 and http_error.code != 429:  # client errors are not transient
+                    raise
+                error = http_error
+            except (urllib.error.URLError, OSError) as network_error:
+                error = network_error
+            if attempt == self.retries:
+                raise EutilsError(utility + ' failed after ' + str(self.retries + 1) + ' attempts: ' + str(error))
+            time.sleep(self.backoff * 2 ** attempt)
+
+    def read_xml(self, utility, **params):
+        root = ET.fromstring(self.request(utility, **params))
+        error = root.find('ERROR')
+        if error is not None:
+            raise EutilsError(utility + ': ' + str(error.text))
+        return root
+
+    def esearch(self, db, term):
+        """ Run a search, keeping its results on the history server: returns (count, history) """
+        root = self.read_xml('esearch', db=db, term=term, usehistory='y', retmax=0)
+        history = {'WebEnv': root.findtext('WebEnv'), 'query_key': root.findtext('QueryKey')}
+        return int(root.findtext('Count')), history
+
+    def accessions(self, db, history, retstart, retmax):
+        """ Accession.version numbers of a slice of a search stored on the history server """
+        text = self.request('efetch', db=db, rettype='acc', retmode='text', retstart=retstart, retmax=retmax, **history)
+        return [line.strip() for line in text.splitlines() if line.strip() != '']
+
+    def epost(self, db, ids):
+        """ Upload a list of IDs to the history server """
+        root = self.read_xml('epost', db=db, id=','.join(ids))
+        return {'WebEnv': root.findtext('WebEnv'), 'query_key': root.findtext('QueryKey')}
+
+    def fetch_batches(self, db, ids, batch_size=500, workers=3, rettype='gb', retmode='text'):
+        """ Post IDs to the history server and fetch their records in batches, several at a time.
+        Yields (batch IDs, text), in order, where text is None if the batch could not be downloaded """
+        if len(ids) == 0:
+            return
+        history = self.epost(db, ids)
+        complete = (lambda text: text.rstrip().endswith('//')) if rettype == 'gb' else None
+
+        def fetch(retstart):
+            try:
+                return self.request('efetch', check=complete, db=db, rettype=rettype, retmode=retmode,
+                                    retstart=retstart, retmax=batch_size, **history)
+            except (EutilsError, urllib.error.URLError) as error:
+                print('\t- Batch of ' + str(len(ids[retstart:retstart + batch_size])) + ' records failed: ' + str(error))
+                return None
+
+        # keep up to two batches per worker in flight, while earlier batches are processed by the caller
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            pending = deque()
+            for retstart in range(0, len(ids), batch_size):
+                pending.append((retstart, executor.submit(fetch, retstart)))
+                if len(pending) >= 2 * max(workers, 1):
+                    start, future = pending.popleft()
+                    yield ids[start:start + batch_size], future.result()
+            while pending:
+                start, future = pending.popleft()
+                yield ids[start:start + batch_size], future.result()
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+"""
+Local HTTP server mimicking the NCBI E-utilities used by download_ncbi_data.py, for tests.
+
+It serves synthetic GenBank records through esearch, epost and efetch (rettype
+'acc' or 'gb'). A fraction of requests can fail with HTTP 502, and a fraction
+of GenBank batches can be truncated, to exercise retries.
+
+Usage:
+    python scripts/eutils_stub.py --port 8765 --records 1500 --fail-rate 0.3
+    python scripts/download_ncbi_data.py --eutils-url http://127.0.0.1:8765/ ...
+"""
+
+import argparse
+import random
+import threading
+import urllib.parse
+from io import StringIO
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from Bio import SeqIO
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+from Bio.SeqFeature import SeqFeature, SimpleLocation, Reference
+
+PLACES = ['Brazil: SP, Campinas', 'Brazil: Bahia', 'Brazil: BA', 'Peru', 'USA: New York, Albany', 'Colombia']
+DATES = ['2021-03-05', '2020', '2019-07', '05-Mar-2021']
+HOSTS = ['Homo sapiens', 'Aedes aegypti']
+
+
+def make_records(size, seed=7):
+    """ Synthetic GenBank records: list of (accession.version, qualifiers of the source feature, GenBank text) """
+    rng = random.Random(seed)
+    records = []
+    for i in range(size):
+        accno = 'XX%06d' % i
+        sequence = ''.join(rng.choice('ACGT') for _ in range(rng.randrange(80, 200)))
+        seq_record = SeqRecord(Seq(sequence), id=accno + '.1', name=accno, description='synthetic virus ' + str(i))
+        seq_record.annotations['molecule_type'] = 'DNA'
+
+        publication = Reference()
+        publication.authors = 'Lima,A.'
+        publication.title = 'Genomes'
+        publication.journal = 'Unpublished'
+        submission = Reference()
+        submission.authors = 'Silva,J., Souza,M.'
+        submission.title = 'Direct Submission'
+        submission.journal = 'Submitted (%02d-MAR-2021) Lab, Brazil' % (i % 28 + 1)
+        seq_record.annotations['references'] = [publication, submission] if i % 5 else [publication]
+
+        qualifiers = {'host': [HOSTS[i % 2]], 'country': [rng.choice(PLACES)], 'collection_date': [rng.choice(DATES)]}
+        if i % 11 == 0:
+            del qualifiers['collection_date']
+        seq_record.features.append(SeqFeature(SimpleLocation(0, len(sequence)), type='source', qualifiers=qualifiers))
+
+        handle = StringIO()
+        SeqIO.write(seq_record, handle, 'gb')
+        records.append((accno + '.1', qualifiers, handle.getvalue()))
+    return records
+
+
+class EutilsStub:
+    """ E-utilities stub server, running in a background thread """
+
+    def __init__(self, records, port=0, fail_rate=0.0, seed=7):
+        self.accessions = [accession for accession, qualifiers, text in records]
+        self.texts = {accession: text for accession, qualifiers, text in records}
+        self.fail_rate = fail_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.posts = {}
+        self.failures = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self.handler())
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:' + str(self.server.server_address[1]) + '/'
+
+    def failure(self):
+        """ Outcome of a request: None, 'error' or 'truncate' """
+        with self.lock:
+            if self.rng.random() >= self.fail_rate:
+                return None
+            self.failures += 1
+            return self.rng.choice(['error', 'truncate'])
+
+    def respond(self, utility, params):
+        """ HTTP status and body of a request """
+        failure = self.failure()
+        if failure == 'error':
+            return 502, 'Bad Gateway'
+
+        if utility == 'esearch':
+            return 200, ('<?xml version="1.0" encoding="UTF-8" ?>\n<eSearchResult><Count>' + str(len(self.accessions)) +
+                         '</Count><RetMax>0</RetMax><QueryKey>1</QueryKey><WebEnv>STUB</WebEnv></eSearchResult>')
+        elif utility == 'epost':
+            with self.lock:
+                query_key = str(len(self.posts) + 2)
+                self.posts[query_key] = params['id'].split(',')
+            return 200, ('<?xml version="1.0" encoding="UTF-8" ?>\n<ePostResult><QueryKey>' + query_key +
+                         '</QueryKey><WebEnv>STUB</WebEnv></ePostResult>')
+        elif utility == 'efetch':
+            start, size = int(params.get('retstart', 0)), int(params.get('retmax', 20))
+            if params.get('rettype') == 'acc':
+                return 200, ''.join(accession + '\n' for accession in self.accessions[start:start + size])
+            ids = self.accessions if params.get('query_key') == '1' else self.posts.get(params.get('query_key'), [])
+            body = ''.join(self.texts[accession] for accession in ids[start:start + size] if accession in self.texts)
+            if failure == 'truncate':
+                body = body[:-10]  # cut within the last record, as in interrupted transfers
+            return 200, body
+        return 400, 'Unknown utility: ' + utility
+
+    def handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                data = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+                params = dict(urllib.parse.parse_qsl(data))
+                utility = self.path.rstrip('/').split('/')[-1].replace('.fcgi', '')
+                status, body = stub.respond(utility, params)
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/xml' if body.startswith('<?xml') else 'text/plain')
+                self.end_headers()
+                self.wfile.write(body.encode('utf-8'))
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Local server mimicking NCBI E-utilities, serving synthetic GenBank records",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--port", required=False, type=int, default=8765, help="Port of the server")
+    parser.add_argument("--records", required=False, type=int, default=1500, help="Number of synthetic records")
+    parser.add_argument("--fail-rate", required=False, type=float, default=0.0, help="Fraction of requests failing with HTTP 502 or, for GenBank batches, truncated")
+    parser.add_argument("--seed", required=False, type=int, default=7, help="Seed of the synthetic records and failures")
+    args = parser.parse_args()
+
+    stub = EutilsStub(make_records(args.records, args.seed), port=args.port, fail_rate=args.fail_rate, seed=args.seed)
+    print('\nServing ' + str(args.records) + ' records at ' + stub.url + ' (Ctrl+C to stop)\n')
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        stub.server.server_close()
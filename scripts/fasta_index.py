@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+"""
+Persistent byte-offset index for FASTA files, stored as a '.fxi' sidecar.
+
+Each record is indexed by its full header line (as in SeqIO's 'description'),
+keeping the first occurrence of duplicated headers. The sidecar records the
+size and modification time of the indexed file, and is rebuilt whenever any
+of them changes, or when it does not hold as many valid lines as records it
+declares (e.g. a sidecar left incomplete by an interrupted run). It is written
+to a temporary file first, and then moved into place.
+
+Sidecar format (tab-separated):
+    #fxi    <file size>    <file mtime_ns>    <number of records>
+    header    offset    span    length    line_width
+
+'offset' is the byte position of the first sequence line, 'span' is the number
+of bytes taken by the sequence lines (line breaks included), 'length' is the
+number of bases, and 'line_width' is the width (in bytes) of the first
+sequence line, line break included.
+"""
+
+import mmap
+import os
+
+INDEX_SUFFIX = '.fxi'
+WHITESPACE = b' \t\r\n'
+
+
+def iter_headers(fasta):
+    """ Yield FASTA headers (without '>') in file order, without loading sequences """
+    with open(fasta, 'rb') as handle:
+        for line in handle:
+            if line.startswith(b'>'):
+                yield line[1:].rstrip().decode('utf-8')
+
+
+def iter_blocks(data, start=0, end=None):
+    """ Yield (header, sequence start, sequence end) for records starting between two byte positions of a FASTA buffer """
+    size = len(data) if end is None else end
+    if data[start:start + 1] == b'>':
+        pos = start
+    else:  # skip anything before the first header, such as blank lines
+        pos = data.find(b'\n>', start, size)
+        if pos != -1:
+            pos += 1
+    while pos != -1 and pos < size:
+        header_end = data.find(b'\n', pos)
+        if header_end == -1:
+            header_end = len(data)
+        header = data[pos + 1:header_end].rstrip()
+        seq_start = min(header_end + 1, len(data))
+        next_record = data.find(b'\n>', header_end)
+        seq_end = len(data) if next_record == -1 else next_record + 1
+        yield header, seq_start, seq_end
+        pos = -1 if next_record == -1 else seq_end
+
+
+def scan_fasta(fasta):
+    """ Yield (header, offset, span, length, line_width) for every record in a FASTA file """
+    if os.path.getsize(fasta) == 0:
+        return
+    with open(fasta, 'rb') as handle:
+        with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for header, start, end in iter_blocks(data):
+                block = data[start:end]
+                length = len(block.translate(None, WHITESPACE))
+                line_width = block.find(b'\n') + 1 or len(block)
+                yield header.decode('utf-8'), start, end - start, length, line_width
+
+
+class FastaIndex:
+    """ Random access to FASTA records by header, backed by a persistent sidecar index """
+
+    def __init__(self, fasta, index_file=None, rebuild=False):
+        self.fasta = fasta
+        self.index_file = index_file or fasta + INDEX_SUFFIX
+        self.records = {}
+        self._handle = None
+
+        stats = os.stat(fasta)
+        self.signature = (str(stats.st_size), str(stats.st_mtime_ns))
+        if rebuild or not self._load():
+            self._build()
+
+    def _load(self):
+        # read a previously saved index, if still valid for the current FASTA file
+        if not os.path.isfile(self.index_file):
+            return False
+        with open(self.index_file, encoding='utf-8') as infile:
+            fields = infile.readline().rstrip('\n').split('\t')
+            if len(fields) != 4 or tuple(fields[1:3]) != self.signature:
+                return False
+            try:
+                for line in infile:
+                    header, offset, span, length, line_width = line.rstrip('\n').rsplit('\t', 4)  # headers may contain tabs
+                    self.records[header] = (int(offset), int(span), int(length), int(line_width))
+            except ValueError:  # torn line
+                self.records = {}
+                return False
+        if str(len(self.records)) != fields[3]:  # incomplete sidecar
+            self.records = {}
+            return False
+        return True
+
+    def _build(self):
+        print('Indexing FASTA file: ' + self.fasta)
+        for header, offset, span, length, line_width in scan_fasta(self.fasta):
+            if header not in self.records: # keep only the first occurrence of duplicated headers
+                self.records[header] = (offset, span, length, line_width)
+
+        tmp_file = self.index_file + '.tmp'
+        try:
+            with open(tmp_file, 'w', encoding='utf-8') as outfile:
+                outfile.write('#fxi\t' + '\t'.join(self.signature) + '\t' + str(len(self.records)) + '\n')
+                for header, values in self.records.items():
+                    outfile.write(header + '\t' + '\t'.join(str(v) for v in values) + '\n')
+            os.replace(tmp_file, self.index_file)
+        except OSError:
+            print('\t- WARNING! FASTA index could not be saved: ' + self.index_file)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, header):
+        return header in self.records
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def length(self, header):
+        return self.records[header][2]
+
+    def fetch(self, header):
+        """ Return the sequence of a record, as a string without line breaks """
+        if self._handle is None:
+            self._handle = open(self.fasta, 'rb')
+        offset, span, length, line_width = self.records[header]
+        self._handle.seek(offset)
+        return self._handle.read(span).translate(None, WHITESPACE).decode('utf-8')
+
+    def iter_selected(self, ids):
+        """ Yield (header, sequence) for the requested headers found in the index, in file order """
+        selected = sorted(set(ids) & self.records.keys(), key=lambda header: self.records[header][0])
+        for header in selected:
+            yield header, self.fetch(header)
+
+    def items(self):
+        """ Yield (header, sequence) for all unique records, in file order """
+        return self.iter_selected(self.records.keys())
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -22,6 +22,7 @@ if __name__ == '__main__':
     parser.add_argument("--remove", required=False, help="List of samples to remove, in all instances")
     parser.add_argument("--scheme", required=True, help="Subsampling scheme")
     parser.add_argument("--report", required=False, help="Report listing samples per category")
+    parser.add_argument("--seed", required=False, type=int, help="Seed of the random number generator, for reproducible selections")
     args = parser.parse_args()
 
     metadata = args.metadata
@@ -29,6 +30,7 @@ if __name__ == '__main__':
     remove = args.remove
     scheme = args.scheme
     report = args.report
+    seed = args.seed
 
 
 
@@ -74,11 +76,9 @@ if __name__ == '__main__':
 
 
     # print(dfN['strain'].tolist())
-    name_accno = {}
-    for genome in to_keep:
-        if genome in dfN['strain'].tolist():
-            accno = dfN.loc[dfN['strain'] == genome, 'gisaid_epi_isl'].values[0]
-            name_accno[genome] = accno
+    # strain > accession index, keeping the first accession of duplicated strain names
+    strain_accno = dfN.drop_duplicates(subset='strain', keep='first').set_index('strain')['gisaid_epi_isl'].to_dict()
+    name_accno = {genome: strain_accno[genome] for genome in to_keep if genome in strain_accno}
 
     # drop lines if samples are set to be ignored
     for column, names in ignore.items():
@@ -97,8 +97,8 @@ if __name__ == '__main__':
 
     print('\n* Dropping sequences with incomplete date...')
     # drop rows with incomplete dates
-    dfN = dfN[dfN['date'].apply(lambda x: len(x.split('-')) == 3)] # accept only full dates
-    dfN = dfN[dfN['date'].apply(lambda x: 'X' not in x)] # exclude -XX-XX missing dates
+    dfN = dfN[dfN['date'].str.count('-') == 2] # accept only full dates
+    dfN = dfN[~dfN['date'].str.contains('X', regex=False)] # exclude -XX-XX missing dates
 
     # convert string dates into date format
     dfN['date'] = pd.to_datetime(dfN['date']) # coverting to datetime format
@@ -108,11 +108,28 @@ if __name__ == '__main__':
     print('\n* Assigning epiweek column...')
     # get epiweek end date, create column
     dfN['date'] = pd.to_datetime(dfN['date'], errors='coerce')
-    dfN['epiweek'] = dfN['date'].apply(lambda x: Week.fromdate(x, system="cdc").enddate())
+    epiweeks = {date: Week.fromdate(date, system="cdc").enddate() for date in dfN['date'].drop_duplicates()}  # Timestamps, in any pandas version
+    dfN['epiweek'] = dfN['date'].map(epiweeks)
 
 
     ## SAMPLE FOCAL AND CONTEXTUAL SEQUENCES
     print('\n* Filtering based on sampling scheme...')
+    rng = np.random.default_rng(seed)
+
+    # rows are referred to by their positions in dfN, and genomes sampled in a category are marked as taken
+    dates = dfN['date'].to_numpy()
+    epiweek_codes, epiweek_bins = pd.factorize(dfN['epiweek'], sort=True)
+    accno_codes, accnos = pd.factorize(dfN['gisaid_epi_isl'])
+    identifiers = {id: dfN[id].to_numpy() for id in results.keys()}
+    taken = np.zeros(len(accnos), dtype=bool)
+
+    # positions of rows with each value, per column used in the scheme
+    indices = {}
+    def rows_matching(column, value):
+        if column not in indices:
+            indices[column] = dfN.groupby(column, sort=False).indices
+        return indices[column].get(value, np.array([], dtype=np.intp))
+
     purposes = ['focus', 'context']
     subsamplers = [] # list of focal and contextual categories
     for category in purposes:
@@ -129,14 +146,15 @@ if __name__ == '__main__':
                 if value1 not in results[id][filter1].keys():
                     results[id][filter1][value1] = []
 
-            # keep only data that match filter1
-            dfFilter = dfN[dfN[filter1].isin([value1])]
+            # keep only data that match filter1, and were not sampled yet
+            rows = rows_matching(filter1, value1)
+            rows = rows[~taken[accno_codes[rows]]]
 
             filter2 = dfS.iloc[idx]['filter2']
             value2 = dfS.iloc[idx]['value2']
             if value2 not in [None, np.nan]:
                 print('\t    - Also filtering by ' + filter2 + ': ' + value2)
-                dfFilter = dfFilter[dfFilter[filter2].isin([value2])]
+                rows = np.intersect1d(rows, rows_matching(filter2, value2), assume_unique=True)
 
             # define new chronological boundaries, if provided
             min_date, max_date = start, end
@@ -150,36 +168,36 @@ if __name__ == '__main__':
                 print('\t    - Applying end time filter: ' + max_date)
 
             # drop any row with dates outside the start/end dates
-            mask = (dfFilter['date'] >= min_date) & (dfFilter['date'] <= max_date)
-            dfFilter = dfFilter.loc[mask]  # apply mask
-            # print(dfFilter[['strain', 'date']])
+            mask = (dates[rows] >= pd.Timestamp(min_date).to_datetime64()) & (dates[rows] <= pd.Timestamp(max_date).to_datetime64())
+            rows = rows[mask]  # apply mask
 
-            gEpiweek = dfFilter.groupby('epiweek')
             sample_size = dfS.iloc[idx]['sample_size']
-            total_genomes = dfFilter[filter1].count()
+            total_genomes = len(rows)
             # print(total_genomes, sample_size)
+            if total_genomes == 0:
+                continue
+
+            # genomes sampled per epiweek: proportional to genomes in bin, up to all genomes available
+            bins = epiweek_codes[rows]
+            bin_pool = np.bincount(bins, minlength=len(epiweek_bins))
+            sampled = np.minimum(np.ceil((bin_pool / total_genomes) * sample_size).astype(int), bin_pool)
 
-            drop_now = []
-            for epiweek, dfEpiweek in gEpiweek:
-                bin_pool = dfEpiweek['epiweek'].count() # genomes in bin
-                sampled = int(np.ceil((bin_pool/total_genomes) * sample_size)) # proportion sampled from bin
-                if sampled > bin_pool: # if requested amount is higher than available genomes, get all
-                    sampled = bin_pool
+            # genome selector: rank rows by random keys within each epiweek, and keep the top ones
+            order = np.lexsort((rng.random(total_genomes), bins))
+            rank = np.arange(total_genomes) - (np.cumsum(bin_pool) - bin_pool)[bins[order]]
+            random_subset = rows[order[rank < sampled[bins[order]]]]
 
-                # genome selector
-                random_subset = dfEpiweek.sample(n=sampled)
-                for id in results.keys():
-                    selected = random_subset[id].to_list()
-                    results[id][filter1][value1] = results[id][filter1][value1] + selected
-                    if id == 'gisaid_epi_isl':
-                        drop_now = drop_now + selected
+            for id in results.keys():
+                selected = identifiers[id][random_subset].tolist()
+                results[id][filter1][value1].extend(selected)
 
-            # drop pre-selected samples to prevent duplicates
-            dfN = dfN[~dfN['gisaid_epi_isl'].isin(drop_now)]
+            # mark pre-selected samples as taken, to prevent duplicates
+            taken[accno_codes[random_subset]] = True
 
     ### EXPORT RESULTS
     print('\n\n# Genomes sampled per category in subsampling scheme\n')
-    exported = []
+    exported = set()
+    preselected = set(to_keep)
 
     outfile_names = open('selected_names.txt', 'w')
     outfile_names.write('# Genomes selected on ' + today + '\n')
@@ -192,7 +210,7 @@ if __name__ == '__main__':
         outfile2.write('sample_size' + '\t' + 'category' + '\n')
 
     # export list selected genomes
-    reported = []
+    reported = set()
     genome_count = ''
     for id in results.keys():
         genome_count = 0
@@ -205,15 +223,15 @@ if __name__ == '__main__':
                         print('\t' + entry)
                     if report != None and entry not in reported:
                         outfile2.write(entry + '\n')
-                    reported.append(entry)
+                    reported.add(entry)
 
                     for genome in entries:
-                        if genome not in [exported + to_keep]:
+                        if genome not in exported and genome not in preselected:
                             if id == 'strain':
                                 outfile_names.write(genome + '\n')
                             else:
                                 outfile_accno.write(genome + '\n')
-                            exported.append(genome)
+                            exported.add(genome)
 
     # report selected samples listed in keep.txt
     not_found = []
@@ -229,7 +247,7 @@ if __name__ == '__main__':
                     outfile_accno.write(genome + '\n')
                 else:
                     not_found.append(genome)
-                exported.append(genome)
+                exported.add(genome)
 
 
         warning = 0
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+"""
+Geocoding of place names with a persistent SQLite cache.
+
+Geocoders implement geocode(query), returning a (lat, long) tuple of strings,
+or None when the place is not found. Exceptions (e.g. network errors) are
+reported as failures, and are not cached, so the place is searched again in
+the next run.
+"""
+
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from rate_limit import RateLimiter
+
+NOT_FOUND = ('NA', 'NA')
+
+
+class NominatimGeocoder:
+    """ OpenStreetMap geocoding, through geopy """
+
+    def __init__(self, user_agent="email@gmail.com"):  # add your email here
+        from geopy.geocoders import Nominatim
+        self.geolocator = Nominatim(user_agent=user_agent)
+
+    def geocode(self, query):
+        location = self.geolocator.geocode(query, language='en')
+        if location is None:
+            return None
+        return str(location.latitude), str(location.longitude)
+
+
+class StubGeocoder:
+    """ Offline geocoder for tests, reading coordinates from a TSV file: query, latitude, longitude """
+
+    def __init__(self, coordinates):
+        self.coordinates = {}
+        for line in open(coordinates, encoding='utf-8').readlines():
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) == 3:
+                self.coordinates[fields[0]] = (fields[1], fields[2])
+
+    def geocode(self, query):
+        return self.coordinates.get(query)
+
+
+class GeocodeCache:
+    """ SQLite cache of geocoding results, storing found and not found places with a time to live """
+
+    def __init__(self, database, ttl_days=90):
+        self.connection = sqlite3.connect(database)
+        self.ttl = ttl_days * 86400
+        self.connection.execute('CREATE TABLE IF NOT EXISTS geocodes '
+                                '(query TEXT PRIMARY KEY, lat TEXT, long TEXT, updated REAL)')
+
+    def get(self, query):
+        """ Cached coordinates of a place, NOT_FOUND for cached misses, or None if absent or expired """
+        row = self.connection.execute('SELECT lat, long, updated FROM geocodes WHERE query = ?', (query,)).fetchone()
+        if row is None or time.time() - row[2] > self.ttl:
+            return None
+        if row[0] is None:
+            return NOT_FOUND
+        return row[0], row[1]
+
+    def put_many(self, entries):
+        """ Save (query, coordinates) pairs, where coordinates are None for places not found """
+        now = time.time()
+        rows = [(query, *(coord if coord is not None else (None, None)), now) for query, coord in entries]
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO geocodes VALUES (?, ?, ?, ?)', rows)
+
+    def close(self):
+        self.connection.close()
+
+
+def geocode_many(queries, geocoder, cache=None, workers=4, rate=1.0, limiter=None):
+    """ Geocode unique queries, concurrently and under a global rate limit, returning a dict query > (lat, long) or NOT_FOUND
+
+    Callers geocoding in several batches should pass the same 'limiter' to all of them, so that the rate limit
+    also holds across batches; otherwise a new one is created, allowing 'rate' calls per second.
+    """
+    results = {}
+    pending = []
+    for query in dict.fromkeys(queries):
+        coord = cache.get(query) if cache is not None else None
+        if coord is None:
+            pending.append(query)
+        else:
+            results[query] = coord
+
+    if limiter is None:
+        limiter = RateLimiter(rate)
+
+    def search(query):
+        limiter.wait()
+        try:
+            return query, geocoder.geocode(query), True
+        except Exception:
+            return query, None, False
+
+    searched = []
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        for query, coord, completed in executor.map(search, pending):
+            results[query] = coord if coord is not None else NOT_FOUND
+            if completed:
+                searched.append((query, coord))
+
+    if cache is not None:
+        cache.put_many(searched)
+    return results
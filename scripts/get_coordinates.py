@@ -7,11 +7,9 @@
 # Last update: 2023-03-03
 
 import pandas as pd
-from geopy.geocoders import Nominatim
 import argparse
-import numpy as np
-
-geolocator = Nominatim(user_agent="email@gmail.com")  # add your email here
+from geocoding import NominatimGeocoder, StubGeocoder, GeocodeCache, geocode_many
+from rate_limit import RateLimiter
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -21,12 +19,20 @@ if __name__ == '__main__':
     parser.add_argument("--metadata", required=True, help="Nextstrain metadata file")
     parser.add_argument("--columns", nargs='+', type=str, help="list of columns that need coordinates")
     parser.add_argument("--cache", required=False, help="TSV file with pre-processed latitudes and longitudes")
+    parser.add_argument("--geocache", required=False, help="SQLite database caching geocoding results, including places not found")
+    parser.add_argument("--cache-ttl", type=float, default=90, help="Days before cached geocoding results are searched again")
+    parser.add_argument("--geocoder", default='nominatim', choices=['nominatim', 'stub'],
+                        help="Geocoding service: Nominatim, or a local stub reading coordinates from --stub-coordinates")
+    parser.add_argument("--stub-coordinates", required=False, help="TSV file with query, latitude and longitude, used by the stub geocoder")
+    parser.add_argument("--workers", type=int, default=4, help="Number of concurrent geocoding requests")
+    parser.add_argument("--rate", type=float, default=1.0, help="Maximum number of geocoding requests per second")
     parser.add_argument("--output", required=True, help="TSV file containing geographic coordinates")
     args = parser.parse_args()
 
     metadata = args.metadata
     columns = args.columns
     cache = args.cache
+    geocache = args.geocache
     output = args.output
 
     # metadata = path + 'results/final_metadata.tsv'
@@ -73,50 +79,70 @@ if __name__ == '__main__':
                     pass
 
 
-    # find coordinates for locations not found in cache or XML file
-    def find_coordinates(place):
-        try:
-            location = geolocator.geocode(place, language='en')
-            lat, long = location.latitude, location.longitude
-            coord = (str(lat), str(long))
-            return coord
-        except:
-            coord = ('NA', 'NA')
-            return coord
+    # unique places, and each of their hierarchy prefixes (e.g. country, division), in order of appearance
+    traits = [trait for trait in columns if trait != 'region']
+    addresses = dict.fromkeys(zip(*[dfN[trait].values.tolist() for trait in traits]))
+    queries = {}
+    for address in addresses:
+        for position, level in enumerate(traits):
+            queries.setdefault((level, address[0:position + 1]))
+
+
+    def search_string(place):
+        new_query = []
+        for name in place:
+            if name not in new_query:
+                new_query.append(name)
+        return ', '.join(new_query)
 
 
-    queries = []
-    pinpoints = [dfN[trait].values.tolist() for trait in columns if trait != 'region']
-    for address in zip(*pinpoints):
-        traits = [trait for trait in columns if trait != 'region']
-        for position, place in enumerate(address):
-            level = traits[position]
-            query = list(address[0:position + 1])
-            queries.append((level, query))
+    empty_values = {'', 'NA', 'NAN', 'unknown', '-', None}
+
+    # queries of places missing from the TSV cache, per place name, in order of appearance
+    candidates = {}
+    for trait, place in queries:
+        target = place[-1]
+        if target not in empty_values and target not in results[trait]:
+            candidates.setdefault((trait, target), []).append(search_string(place))
+
+    if args.geocoder == 'stub':
+        geocoder = StubGeocoder(args.stub_coordinates)
+    else:
+        geocoder = NominatimGeocoder()
+    geocoded = {}
+    if len(candidates) > 0:
+        geocode_cache = GeocodeCache(geocache, args.cache_ttl) if geocache not in ['', None] else None
+        limiter = RateLimiter(args.rate)  # shared by all rounds
+        # each round searches the next query of all places not found yet, so that places sharing a name
+        # with one already found (e.g. municipalities in different states) are not searched
+        while len(candidates) > 0:
+            pending = {}
+            for key, strings in candidates.items():
+                while len(strings) > 0 and strings[0] in geocoded:
+                    strings.pop(0)
+                if len(strings) > 0:
+                    pending[key] = strings.pop(0)
+            geocoded.update(geocode_many(list(dict.fromkeys(pending.values())), geocoder, geocode_cache,
+                                         workers=args.workers, limiter=limiter))
+            candidates = {key: candidates[key] for key, string in pending.items() if 'NA' in geocoded[string]}
+        if geocode_cache is not None:
+            geocode_cache.close()
 
 
     not_found = []
-    for unknown_place in queries:
-        # print(unknown_place)
-        trait, place = unknown_place[0], unknown_place[1]
+    missing = set()
+    for trait, place in queries:
         target = place[-1]
-        if target not in ['', 'NA', 'NAN', 'unknown', '-', np.nan, None]:
+        if target not in empty_values:
 
             if target not in results[trait]:
-                new_query = []
-                for name in place:
-                    if name not in new_query:
-                        new_query.append(name)
-
-                item = (trait, ', '.join(new_query))
-                coord = ('NA', 'NA')
-                # print(item)
-                if item not in not_found:
-                    coord = find_coordinates(', '.join(new_query))  # search coordinates
+                item = (trait, search_string(place))
+                coord = geocoded[item[1]]
                 if 'NA' in coord:
-                    if item not in not_found:
+                    if item not in missing:
+                        missing.add(item)
                         not_found.append(item)
-                        print('\t* WARNING! Coordinates not found for: ' + trait + ', ' + ', '.join(new_query))
+                        print('\t* WARNING! Coordinates not found for: ' + trait + ', ' + item[1])
                 else:
                     print('\t→ ' + trait + ', ' + target + '. Coordinates = ' + ', '.join(coord))
                     entry = {target: coord}
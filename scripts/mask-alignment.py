@@ -4,9 +4,89 @@
 Mask initial bases from alignment FASTA
 """
 import argparse
+import mmap
+import os
+from multiprocessing import Pool
 import Bio
 import Bio.SeqIO
 from Bio.Seq import Seq
+import numpy as np
+from fasta_index import iter_blocks
+
+WRAP = 60  # line width used by Bio.SeqIO.write
+BUFFER_SIZE = 16 * 1024 * 1024
+MIN_CHUNK_SIZE = 4 * 1024 * 1024  # smallest byte range handled by each worker task
+MASK_CHAR = ord('N')
+LINE_BREAKS = (ord('\n'), ord('\r'), ord(' '))
+
+
+def build_mask(length, begin_length, end_length, mask_sites):
+    """ Boolean array flagging positions to be masked in sequences with a given length """
+    mask = np.zeros(max(length, begin_length + end_length), dtype=bool)
+    mask[:begin_length] = True
+    if end_length > 0:
+        mask[len(mask) - end_length:] = True
+    if mask_sites:
+        mask[np.array(mask_sites) - 1] = True
+    return mask
+
+
+def wrap_sequence(seq):
+    """ Split a sequence array into FASTA lines with WRAP characters each """
+    full_lines = len(seq) // WRAP
+    lines = np.empty((full_lines, WRAP + 1), dtype=np.uint8)
+    lines[:, :WRAP] = seq[:full_lines * WRAP].reshape(full_lines, WRAP)
+    lines[:, WRAP] = ord('\n')
+    remainder = seq[full_lines * WRAP:]
+    if len(remainder) == 0:
+        return lines.tobytes()
+    return lines.tobytes() + remainder.tobytes() + b'\n'
+
+
+def iter_masked(data, begin_length, end_length, mask_sites, start=0, end=None):
+    """ Yield masked FASTA records, as bytes, for records starting between two byte positions of an alignment """
+    masks = {}  # masks are computed once per sequence length
+    for header, seq_start, seq_end in iter_blocks(data, start, end):
+        seq = np.frombuffer(data, dtype=np.uint8, count=seq_end - seq_start, offset=seq_start)
+        keep = seq != LINE_BREAKS[0]
+        for char in LINE_BREAKS[1:]:
+            keep &= seq != char
+        seq = seq[keep]  # contiguous copy of the sequence, masked in place
+
+        if len(seq) not in masks:
+            masks[len(seq)] = build_mask(len(seq), begin_length, end_length, mask_sites)
+        mask = masks[len(seq)]
+        if len(mask) > len(seq):  # sequence shorter than the masked ends
+            seq = np.full(len(mask), MASK_CHAR, dtype=np.uint8)
+        seq[mask] = MASK_CHAR
+        yield b'>' + header + b'\n' + wrap_sequence(seq)
+
+
+def split_records(data, chunks):
+    """ Split a FASTA buffer into record-aligned (start, end) byte ranges """
+    step = max(len(data) // chunks, MIN_CHUNK_SIZE)
+    bounds = [0]
+    while bounds[-1] + step < len(data):
+        next_record = data.find(b'\n>', bounds[-1] + step)
+        if next_record == -1:
+            break
+        bounds.append(next_record + 1)
+    bounds.append(len(data))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+worker_data = None  # alignment mapped in each worker process
+
+def init_worker(alignment):
+    global worker_data
+    infile = open(alignment, 'rb')
+    worker_data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def mask_range(task):
+    """ Mask all records in a byte range of the alignment mapped by the worker """
+    start, end, begin_length, end_length, mask_sites = task
+    return b''.join(iter_masked(worker_data, begin_length, end_length, mask_sites, start, end))
 
 
 if __name__ == '__main__':
@@ -18,25 +98,45 @@ if __name__ == '__main__':
     parser.add_argument("--mask-from-beginning", type = int, required=True, help="number of bases to mask from start")
     parser.add_argument("--mask-from-end", type = int, help="number of bases to mask from end")
     parser.add_argument("--mask-sites", nargs='+', type = int,  help="list of sites to mask")
+    parser.add_argument("--engine", default='mmap', choices=['mmap', 'seqio'],
+                        help="Masking engine: memory-mapped NumPy masking, or record-by-record Bio.SeqIO processing")
+    parser.add_argument("--threads", type=int, default=1, help="Number of processes used by the 'mmap' engine")
     parser.add_argument("--output", required=True, help="FASTA file of output alignment")
     args = parser.parse_args()
 
-    being_length = 0
+    begin_length = 0
     if args.mask_from_beginning:
         begin_length = args.mask_from_beginning
     end_length = 0
     if args.mask_from_end:
         end_length = args.mask_from_end
 
-    with open(args.output, 'w') as outfile:
-        for record in Bio.SeqIO.parse(args.alignment, 'fasta'):
-            seq = str(record.seq)
-            start = "N" * begin_length
-            middle = seq[begin_length:-end_length]
-            end = "N" * end_length
-            seq_list = list(start + middle + end)
-            if args.mask_sites:
-                for site in args.mask_sites:
-                    seq_list[site-1] = "N"
-            record.seq = Seq("".join(seq_list))
-            Bio.SeqIO.write(record, outfile, 'fasta')
+    if args.engine == 'seqio':
+        with open(args.output, 'w') as outfile:
+            for record in Bio.SeqIO.parse(args.alignment, 'fasta'):
+                seq = str(record.seq)
+                start = "N" * begin_length
+                middle = seq[begin_length:max(len(seq) - end_length, 0)]
+                end = "N" * end_length
+                seq_list = list(start + middle + end)
+                if args.mask_sites:
+                    for site in args.mask_sites:
+                        seq_list[site-1] = "N"
+                record.seq = Seq("".join(seq_list))
+                Bio.SeqIO.write(record, outfile, 'fasta')
+
+    else:
+        with open(args.output, 'wb', buffering=BUFFER_SIZE) as outfile:
+            if os.path.getsize(args.alignment) > 0:
+                with open(args.alignment, 'rb') as infile:
+                    with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                        if args.threads > 1:
+                            # mask record-aligned byte ranges in parallel, writing them back in their original order
+                            tasks = [(start, end, begin_length, end_length, args.mask_sites)
+                                     for start, end in split_records(data, args.threads * 4)]
+                            with Pool(args.threads, initializer=init_worker, initargs=(args.alignment,)) as pool:
+                                for chunk in pool.imap(mask_range, tasks):
+                                    outfile.write(chunk)
+                        else:
+                            for record in iter_masked(data, begin_length, end_length, args.mask_sites):
+                                outfile.write(record)
@@ -7,9 +7,63 @@
 
 from Bio import Phylo
 from Bio import SeqIO
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from fasta_index import FastaIndex
 import pandas as pd
 import argparse
 import json
+from collections import Counter
+from multiprocessing import Pool
+import os
+
+JSON_CHUNK_SIZE = 64 * 1024 * 1024  # bytes of JSON lines handled by each worker task
+GISAID_NAME = str.maketrans({' ': None, '\'': '-'})
+
+
+def gisaid_name(name):
+    # normalize GISAID virus names: 'hCoV-19/Brazil/SP 123/2021' > 'Brazil/SP123/2021'
+    return name.replace('hCoV-19/', '').translate(GISAID_NAME)
+
+
+def split_lines(path, chunk_size):
+    # split a file into (start, end) byte ranges, starting and ending at line boundaries
+    bounds = [0]
+    size = os.path.getsize(path)
+    with open(path, 'rb') as infile:
+        while bounds[-1] + chunk_size < size:
+            infile.seek(bounds[-1] + chunk_size)
+            infile.readline()
+            if infile.tell() >= size:
+                break
+            bounds.append(infile.tell())
+    bounds.append(size)
+    return [(path, start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+json_targets = set()
+
+def init_json_reader(targets):
+    global json_targets
+    json_targets = targets
+
+
+def read_json_chunk(task):
+    # decode the JSON lines in a byte range, returning the total of lines and the entries listed as targets
+    path, start, end = task
+    with open(path, 'rb') as infile:
+        infile.seek(start)
+        lines = infile.read(end - start).splitlines()
+
+    selected = []
+    for num, line in enumerate(lines):
+        if not line.strip():
+            continue
+        entry = json.loads(line)
+        header = gisaid_name(entry['covv_virus_name'])
+        if header in json_targets:
+            selected.append((num, header, entry))
+    return len(lines), selected
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -24,6 +78,8 @@ if __name__ == '__main__':
     parser.add_argument("--list", required=True, help="List of target taxa or sequences")
     parser.add_argument("--index", required=False, type=str,  help="Column name in TSV file where the listed taxa are found")
     parser.add_argument("--output", required=True, help="Filtered output file")
+    parser.add_argument("--output-metadata", required=False, help="TSV file with the metadata of sequences extracted from JSON files")
+    parser.add_argument("--threads", required=False, type=int, default=1, help="Number of processes used to decode JSON files")
     args = parser.parse_args()
 
     input = args.input
@@ -32,6 +88,8 @@ if __name__ == '__main__':
     action = args.action[0]
     index = args.index
     output = args.output
+    output_metadata = args.output_metadata
+    threads = args.threads
 
 
     # input = path + "metadata.tsv"
@@ -42,18 +100,22 @@ if __name__ == '__main__':
 
 
     targets = [target.strip() for target in open(list, "r").readlines() if target[0] not in ['\n', '#']]
+    target_ids = set(targets)  # hashed lookups when filtering records
     if format == 'tree':
         tree = Phylo.read(input, 'newick')
         print('Starting tree file processing...')
         # rename clade names
         if action == 'rename':
+            new_names = {}
+            for line in targets:
+                fields = line.split("\t")
+                if len(fields) > 1 and fields[0] not in new_names:  # first entry prevails for repeated names
+                    new_names[fields[0]] = fields[1].strip()
+
             for clade in tree.find_clades():
-                for line in targets:
-                    oldName = line.split("\t")[0]
-                    newName = line.split("\t")[1].strip()
-                    if str(clade.name) == oldName:
-                        # print('Renaming ' + oldName + ' as ' + newName)
-                        clade.name = newName
+                if str(clade.name) in new_names:
+                    # print('Renaming ' + str(clade.name) + ' as ' + new_names[str(clade.name)])
+                    clade.name = new_names[str(clade.name)]
 
             Phylo.write([tree], output, 'newick')
             print('\nTree file successfully renamed: \'' + output)
@@ -75,18 +137,60 @@ if __name__ == '__main__':
                 prune.append(tax.strip())
 
             if action == 'keep':
-                prune = [item for item in allTaxa if item not in prune]
+                listed = set(prune)
+                prune = [item for item in allTaxa if item not in listed]
+
+            # remove all targets in a single post-order traversal, collapsing nodes left with a single child,
+            # as done by successive calls of tree.prune()
+            def bulk_prune(tree, taxa):
+                remaining = Counter(taxa)  # each listed entry removes one terminal with that name
+                pruned = Counter()
+                result = {}  # clade id > clade replacing it after pruning, or None if removed
+                stack = [(tree.root, False)]
+                while stack:
+                    clade, visited = stack.pop()
+                    if not visited:
+                        stack.append((clade, True))
+                        stack.extend((child, False) for child in reversed(clade.clades))
+                        continue
+
+                    if clade.is_terminal():
+                        if remaining[clade.name] > 0 and clade is not tree.root:
+                            remaining[clade.name] -= 1
+                            pruned[clade.name] += 1
+                            result[id(clade)] = None
+                        else:
+                            result[id(clade)] = clade
+                        continue
+
+                    kept = [result[id(child)] for child in clade.clades if result[id(child)] is not None]
+                    if len(kept) == 1 and len(clade.clades) > 1:  # collapse node left with a single child
+                        child = kept[0]
+                        if child.branch_length is not None:
+                            child.branch_length += clade.branch_length or 0.0
+                        result[id(clade)] = child
+                    elif len(kept) == 0 and len(clade.clades) > 1:  # all descendants were removed
+                        clade.clades = []
+                        result[id(clade)] = None
+                    else:
+                        clade.clades = kept
+                        result[id(clade)] = clade
+
+                if result[id(tree.root)] is not None:
+                    tree.root = result[id(tree.root)]
+                return pruned
 
             # if in prune list, targets are removed
             c = 1
             notintree = []
             print('\n### Filtering taxa from tree\n')
+            pruned = bulk_prune(tree, prune)
             for taxon in prune:
-                try:
-                    tree.prune(target=taxon)
+                if pruned[taxon] > 0:
+                    pruned[taxon] -= 1
                     print(str(c) + ' - ' + taxon + ' was filtered')
                     c += 1
-                except:
+                else:
                     print('Taxon ' + taxon + ' was not found in the tree!')
                     notintree.append(taxon)
 
@@ -119,7 +223,7 @@ if __name__ == '__main__':
                 replacements[old] = new
 
             # perform simple renaming
-            found = []
+            found = set()
             not_found = []
             duplicates = []
             c = 1
@@ -131,7 +235,7 @@ if __name__ == '__main__':
                             entry = ">" + replacements[id] + "\n" + str(seq).upper() + "\n"
                             print(str(c) + '. Renamed - ' + replacements[id])
                             outfile.write(entry)
-                            found.append(replacements[id])
+                            found.add(replacements[id])
                             c += 1
                         else:
                             print('Duplicate found: ' + replacements[id])
@@ -153,27 +257,27 @@ if __name__ == '__main__':
             print('\n### A total of ' + str(len(found)) + ' sequences were renamed \n')
 
         if action in ['keep', 'remove']:
-            found = []  # store all found headers
+            found = set()  # store all found headers
             count = 1
             with open(output, 'w') as outfile:
-                for fasta in SeqIO.parse(open(input), 'fasta'):
-                    header, seq = fasta.description, fasta.seq
-                    if action == 'keep':
-                        if header not in found and header in targets:
-                            found.append(header)
-                            entry = ">" + header + "\n" + str(seq).upper() + "\n"
+                if action == 'keep':  # fetch only the listed sequences, through the FASTA index
+                    with FastaIndex(input) as fasta_index:
+                        for header, seq in fasta_index.iter_selected(target_ids):
+                            found.add(header)
+                            entry = ">" + header + "\n" + seq.upper() + "\n"
                             outfile.write(entry)
                             print(str(count) + '/' + str(len(targets)) + " - Filtering sequence... " + header)
                             count += 1
 
-                    if action == 'remove':  # remove selected sequences
-                        if header not in found and header not in targets:
-                            entry = ">" + header + "\n" + str(seq).upper() + "\n"
+                if action == 'remove':  # remove selected sequences
+                    for header, seq in SimpleFastaParser(open(input)):  # single streaming pass
+                        if header not in found and header not in target_ids:
+                            entry = ">" + header + "\n" + seq.upper() + "\n"
                             outfile.write(entry)
                         else:
                             print(str(count) + '/' + str(len(targets)) + " - Removing sequence... " + header)
                             count += 1
-                            found.append(header)
+                            found.add(header)
 
                 def Diff(list1, list2):  # compare full list of headers and those found in the previous step. Flag any headers not found
                     notFound = set(list1) - set(list2)
@@ -190,23 +294,39 @@ if __name__ == '__main__':
 
     if format == 'json':
         print('Starting JSON file processing...')
-        found = []
+        found = set()
+        metadata_rows = []
         if action in ['keep']:
+            # decode chunks of lines in parallel, exporting selected entries in their original order
+            tasks = split_lines(input, JSON_CHUNK_SIZE)
+            if threads > 1:
+                pool = Pool(threads, initializer=init_json_reader, initargs=(target_ids,))
+                chunks = pool.imap(read_json_chunk, tasks)
+            else:
+                init_json_reader(target_ids)
+                chunks = map(read_json_chunk, tasks)
+
             with open(output, 'w') as outfile:
-                with open(input) as infile:
-                    count = 0
-                    for line in infile:
-                        entry = json.loads(line)
-                        header = entry['covv_virus_name'].replace('hCoV-19/', '').replace(' ', '').replace('\'', '-')
-                        if header not in found and header in targets:
-                            seq = entry['sequence'].replace('\n', '')
-                            print(str(count) + '. ' + header)
-                            entry = ">" + header + "\n" + seq.upper() + "\n"
-                            outfile.write(entry)
-                            found.append(header)
-                        count += 1
-                        if count % 10000 == 0:
-                            print(count)
+                count = 0
+                for total_lines, selected in chunks:
+                    for num, header, entry in selected:
+                        if header not in found:
+                            seq = entry.pop('sequence').replace('\n', '')
+                            print(str(count + num) + '. ' + header)
+                            outfile.write(">" + header + "\n" + seq.upper() + "\n")
+                            found.add(header)
+                            if output_metadata not in ['', None]:
+                                metadata_rows.append({'strain': header, **entry})
+                    count += total_lines
+                    print(count)
+
+            if threads > 1:
+                pool.close()
+                pool.join()
+
+            if output_metadata not in ['', None]:
+                pd.DataFrame(metadata_rows).to_csv(output_metadata, sep='\t', index=False)
+                print('\nMetadata of ' + str(len(metadata_rows)) + ' sequences exported: ' + output_metadata)
 
     if format == 'tsv':
         df1 = pd.read_csv(input, encoding='utf-8', sep='\t', dtype=str)
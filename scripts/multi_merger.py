@@ -9,12 +9,65 @@
 import pandas as pd
 import os
 import argparse
+import hashlib
+from multiprocessing import Pool
 from pathlib import Path
 
 pd.set_option('display.max_columns', 500)
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
+TABLE_FORMATS = ['tsv', 'csv', 'xls', 'xlsx']
+MANIFEST = 'manifest.tsv'  # index of cached tables: path, mtime (ns), size, pickle file
+
+
+def load_table(file):
+    df = ''
+    if str(file).split('.')[-1] == 'tsv':
+        separator = '\t'
+        df = pd.read_csv(file, encoding='utf-8', sep=separator, dtype='str')
+    elif str(file).split('.')[-1] == 'csv':
+        separator = ','
+        df = pd.read_csv(file, encoding='utf-8', sep=separator, dtype='str')
+    elif str(file).split('.')[-1] in ['xls', 'xlsx']:
+        df = pd.read_excel(file, index_col=None, header=0, sheet_name=0, dtype='str')
+        df.fillna('', inplace=True)
+    else:
+        print('Wrong file format. Compatible file formats: TSV, CSV, XLS, XLSX')
+        exit()
+    return df
+
+
+def file_signature(file):
+    stat = os.stat(file)
+    return str(stat.st_mtime_ns), str(stat.st_size)
+
+
+def read_manifest(cache_dir):
+    manifest = {}
+    manifest_file = os.path.join(cache_dir, MANIFEST)
+    if os.path.isfile(manifest_file):
+        for line in open(manifest_file, encoding='utf-8').readlines():
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) == 4:
+                manifest[fields[0]] = tuple(fields[1:])
+    return manifest
+
+
+def write_manifest(cache_dir, manifest):
+    with open(os.path.join(cache_dir, MANIFEST), 'w', encoding='utf-8') as outfile:
+        for file, entry in manifest.items():
+            outfile.write('\t'.join((file,) + entry) + '\n')
+
+
+def parse_table(task):
+    """ Load a table, saving it as a pickle if a cache file is given """
+    file, cache_file = task
+    df = load_table(file)
+    if cache_file is not None:
+        df.to_pickle(cache_file)
+    return df
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -29,6 +82,8 @@ if __name__ == '__main__':
     parser.add_argument("--filters", required=False, type=str, help="Format: '~column_name:value'. Remove '~' to keep only that data category")
     parser.add_argument("--fillna", required=False, default='', help="Filler to replace NA data points")
     parser.add_argument("--sortby", required=False, nargs='+', type=str, help="Columns to be used to sort the output file")
+    parser.add_argument("--threads", required=False, type=int, default=1, help="Number of processes used to load files")
+    parser.add_argument("--cache", required=False, help="Directory where parsed files are cached, and reused while their modification time and size are unchanged")
     parser.add_argument("--output", required=True, help="Merged file")
     args = parser.parse_args()
 
@@ -39,6 +94,8 @@ if __name__ == '__main__':
     filters = args.filters
     filler = args.fillna
     sortby = args.sortby
+    threads = args.threads
+    cache = args.cache
     output = args.output
 
     # path = '/Users/anderson/google_drive/ITpS/projetos_itps/metasurvBR/data/metadata_genomes/test_multimerger/'
@@ -49,22 +106,6 @@ if __name__ == '__main__':
     # filler = None
     # output = path + 'merged.tsv'
 
-    def load_table(file):
-        df = ''
-        if str(file).split('.')[-1] == 'tsv':
-            separator = '\t'
-            df = pd.read_csv(file, encoding='utf-8', sep=separator, dtype='str')
-        elif str(file).split('.')[-1] == 'csv':
-            separator = ','
-            df = pd.read_csv(file, encoding='utf-8', sep=separator, dtype='str')
-        elif str(file).split('.')[-1] in ['xls', 'xlsx']:
-            df = pd.read_excel(file, index_col=None, header=0, sheet_name=0, dtype='str')
-            df.fillna('', inplace=True)
-        else:
-            print('Wrong file format. Compatible file formats: TSV, CSV, XLS, XLSX')
-            exit()
-        return df
-
     if path in ['', None]:
         path = os.getcwd()
 
@@ -91,7 +132,7 @@ if __name__ == '__main__':
             # print(new_df.size)
             if new_df.empty:
                 df_filtered = df[df[filter_col].isin(filter_val)]
-                new_df = new_df.append(df_filtered)
+                new_df = pd.concat([new_df, df_filtered])
             else:
                 new_df = new_df[new_df[filter_col].isin(filter_val)]
             # print(new_df)#.head())
@@ -114,17 +155,55 @@ if __name__ == '__main__':
             print('\t- Excluding all rows with \'' + filter_col + '\' = \'' + ', '.join(filter_val) + '\'')
             if new_df.empty:
                 df = df[~df[filter_col].isin(filter_val)]
-                new_df = new_df.append(df)
+                new_df = pd.concat([new_df, df])
             else:
                 new_df = new_df[~new_df[filter_col].isin(filter_val)]
             # print(new_df)#.head())
         return new_df
 
-    # load data
-    ldf = []
+    # list input files, skipping the cache directory
+    files = []
     for file in Path(path).rglob(regex):
         # print(file.resolve())
-        subdf = load_table(file.resolve())
+        file = file.resolve()
+        if cache not in ['', None] and Path(cache).resolve() in file.parents:
+            continue
+        if str(file).split('.')[-1] not in TABLE_FORMATS:
+            print('Wrong file format. Compatible file formats: TSV, CSV, XLS, XLSX')
+            exit()
+        files.append(str(file))
+
+    # load tables, reusing cached ones if their files are unchanged
+    tables = {}
+    tasks = []
+    if cache not in ['', None]:
+        os.makedirs(cache, exist_ok=True)
+        manifest = read_manifest(cache)
+        for file in files:
+            signature = file_signature(file)
+            entry = manifest.get(file)
+            if entry is not None and entry[:2] == signature and os.path.isfile(os.path.join(cache, entry[2])):
+                tables[file] = pd.read_pickle(os.path.join(cache, entry[2]))
+            else:
+                pickle_file = hashlib.sha1(file.encode('utf-8')).hexdigest() + '.pkl'
+                manifest[file] = signature + (pickle_file,)
+                tasks.append((file, os.path.join(cache, pickle_file)))
+    else:
+        tasks = [(file, None) for file in files]
+
+    if threads > 1 and len(tasks) > 1:
+        with Pool(min(threads, len(tasks))) as pool:
+            loaded = pool.map(parse_table, tasks)
+    else:
+        loaded = [parse_table(task) for task in tasks]
+    tables.update({file: df for (file, cache_file), df in zip(tasks, loaded)})
+
+    if cache not in ['', None]:
+        write_manifest(cache, manifest)
+
+    ldf = []
+    for file in files:
+        subdf = tables[file]
         if filters not in ['', None]:
             subdf = filter_df(subdf, filters)
         ldf.append(subdf)
@@ -4,7 +4,6 @@
 # Last update: 2023-03-15
 
 from geopy.geocoders import Nominatim
-from shapely.geometry import Point
 from difflib import SequenceMatcher
 import pandas as pd
 import geopandas as gpd
@@ -12,6 +11,7 @@ import numpy as np
 import argparse
 import os
 import os.path
+from shape_layer import load_layer, sjoin_within
 
 # from shapely.errors import ShapelyDeprecationWarning
 # import warnings; warnings.filterwarnings('ignore', "", ShapelyDeprecationWarning)
@@ -34,6 +34,7 @@ if __name__ == '__main__':
     parser.add_argument("--shapefile", required=True, help="Shapefile with polygons to be matched with location names")
     parser.add_argument("--display", required=False, default='no', choices=['no', 'yes'], help="Display header of the shapefile for inspection, and exit?")
     parser.add_argument("--fix-projection", required=False, default='no', choices=['no', 'yes'], help="Fix map projection of second shape file base on the first one provided?")
+    parser.add_argument("--layer-cache", required=False, help="Directory where prepared (parsed and reprojected) shapefile layers are cached")
     parser.add_argument("--geo-columns", required=False, help="List of columns with distinct levels of geographic names to be searched")
     parser.add_argument("--add-geo", required=False, help="Extra column to be added with standard value applicable to all entries, e.g. 'country:Brazil'")
     parser.add_argument("--lat", required=False, default='lat', help="Column containing latitude data, if already existing in input file")
@@ -41,6 +42,7 @@ if __name__ == '__main__':
     parser.add_argument("--cache", required=False, help="TSV file with cached coordinates")
     parser.add_argument("--save-latlong", required=False, default='yes', choices=['no', 'yes'], help="Export coordinate columns 'lat' and 'long'?")
     parser.add_argument("--check-match", required=False, help="Column in shapefile containing the names of locations to be matched")
+    parser.add_argument("--match-cache", required=False, help="TSV file with cached name similarity scores, used by --check-match")
     parser.add_argument("--target", required=False, help="Comma-separated list of shapefile columns to be exported in the final output")
     parser.add_argument("--same-format", required=False, default='yes', choices=['no', 'yes'], help="Should all columns and rows in the input file be exported?")
     parser.add_argument("--output", required=False, help="Name of the TSV output file")
@@ -50,6 +52,7 @@ if __name__ == '__main__':
     shapefile = args.shapefile
     display_header = args.display
     fix_projection = args.fix_projection
+    layer_cache = args.layer_cache
     geo_cols = args.geo_columns
     add_geo_cols = args.add_geo
     output_coordinates = args.save_latlong
@@ -57,6 +60,7 @@ if __name__ == '__main__':
     long_col = args.long
     cache = args.cache
     check_col = args.check_match
+    match_cache = args.match_cache
     target_cols = args.target
     same_file = args.same_format
     output = args.output
@@ -97,9 +101,10 @@ if __name__ == '__main__':
         return df
 
     threshold = 0.75
+    min_threshold = 0.65  # threshold used once short names (up to 4 characters) are found
 
     # load geopandas
-    geodf = gpd.read_file(shapefile)
+    geodf = load_layer(shapefile, epsg=4326 if fix_projection == 'yes' else None, cache_dir=layer_cache)
     if display_header.lower() == 'yes':
         dict_df = geodf.head(1).to_dict('list')
 
@@ -132,7 +137,9 @@ if __name__ == '__main__':
     last_level = geo_cols[-1]
 
     # search coordinates (if any is missing)
-    df2 = gpd.GeoDataFrame(columns = geo_cols + [lat_col, long_col] + ['geometry'])
+    df2_columns = geo_cols + [lat_col, long_col] + ['geometry']
+    df2_frames = []  # location groups, concatenated into the output geodataframe after the search
+    df2_located = []  # flags of groups with coordinates, one per row
     if lat_col not in df1.columns.tolist():
         lat_col = 'lat'
         long_col = 'long'
@@ -180,6 +187,7 @@ if __name__ == '__main__':
 
     # print(df1['state'])
 
+    new_coordinates = []  # rows to be added to the cache
     printed = []
     for i, (name, df) in enumerate(df1.groupby(geo_cols)):
         # for id, row in df.iterrows():
@@ -202,10 +210,8 @@ if __name__ == '__main__':
             lat, long = float(lat), float(long)
             coord = (lat, long)
             found[', '.join(query)] = coord  # record this coordinate as found
-            df['lat'] = lat
-            df['long'] = long
-            df['geometry'] = Point(long, lat)
-            df2 = df2.append(df, ignore_index=True)  # geodataframe used as output
+            df2_frames.append(df.assign(lat=lat, long=long))  # geodataframe used as output
+            df2_located.append(np.ones(len(df.index), dtype=bool))
 #            print('\t- ' + ', '.join(list(name)) + ': ' + str(len(df.index)) + ' samples')
             # print(df)
         else: # if not found yet, search coordinates
@@ -220,7 +226,7 @@ if __name__ == '__main__':
                         for num, column in enumerate(geo_cols):
                             data[column] = query[num]
                         # print(data)
-                        df3 = df3.append(data, ignore_index=True) # populate cache coordinates
+                        new_coordinates.append(data) # populate cache coordinates
             else: # if coordinate was found in previous steps
                 coord = found[', '.join(query)]
                 record = '    (' + coord[0] + ', ' + coord[1] + ') \t→ ' + ', '.join(query)
@@ -234,19 +240,26 @@ if __name__ == '__main__':
                 if ', '.join(query) not in found or same_file == 'yes':
                     # if same_file == 'yes' or '-'.join(query) not in found:
                     lat, long = float(coord[0]), float(coord[1])
-                    df['lat'] = lat
-                    df['long'] = long
-                    df['geometry'] = Point(long, lat)
-                    # df['geometry'] = Point(lat, long)
-                    df2 = df2.append(df, ignore_index=True)  # geodataframe used as output
+                    df2_frames.append(df.assign(lat=lat, long=long))  # geodataframe used as output
+                    df2_located.append(np.ones(len(df.index), dtype=bool))
                     print('\t- ' + ', '.join(query) + ': ' + str(len(df.index)) + ' samples *')
                 found[', '.join(query)] = coord
             else:
-                df2 = df2.append(df, ignore_index=True)  # geodataframe used as output
+                df2_frames.append(df)  # geodataframe used as output
+                df2_located.append(np.zeros(len(df.index), dtype=bool))
                 if ', '.join(query) not in notfound:
                     notfound.append(', '.join(query))
 
-    # print(df2.head())
+    # build the output geodataframe, with points for all located samples
+    if len(df2_frames) > 0:
+        df2 = pd.concat(df2_frames, ignore_index=True)
+        df2_columns += [c for c in df2.columns if c not in df2_columns]
+        located = np.concatenate(df2_located)
+        points = gpd.points_from_xy(pd.to_numeric(df2['long'].where(located)), pd.to_numeric(df2['lat'].where(located)))
+        df2['geometry'] = np.where(located, points, None)
+        df2 = gpd.GeoDataFrame(df2[df2_columns], geometry='geometry')
+    else:
+        df2 = gpd.GeoDataFrame(columns=df2_columns, geometry='geometry')
 
     if len(notfound) > 0:
         print('\nWARNING!\nCoordinates for these entries were not found.\n'
@@ -256,6 +269,12 @@ if __name__ == '__main__':
 
     # print(df3)
 
+    if len(new_coordinates) > 0:
+        if len(df3.columns) > 0:
+            df3 = pd.concat([df3, pd.DataFrame(new_coordinates)], ignore_index=True)
+        else:
+            df3 = pd.DataFrame(new_coordinates)
+
     if cache not in [None, '']:
         if 'place' in df3.columns.tolist():
             df3 = df3.drop(columns=['place', 'coordinates'])
@@ -263,7 +282,6 @@ if __name__ == '__main__':
 
 
     if fix_projection == 'yes':
-        geodf = geodf.to_crs(epsg=4326)
         # get CRS info
         if df2.crs != geodf.crs:
             # print(df2.crs)
@@ -280,9 +298,17 @@ if __name__ == '__main__':
     # print(df2.head())
     # print(geodf.head())
 
-    # find shapes where points are located
-    results = gpd.sjoin(df2, geodf, how='left', op='within')
+    # find shapes where points are located, searching each distinct coordinate once
     target_cols = [c.strip() for c in target_cols.split(',')]
+    coordinates = pd.DataFrame({'x': df2.geometry.x.values, 'y': df2.geometry.y.values})
+    point_ids = coordinates.groupby(['x', 'y'], sort=False).ngroup().values  # -1 for samples without coordinates
+    unique_coordinates = coordinates[point_ids >= 0].drop_duplicates()
+    points = gpd.GeoDataFrame({'point_id': np.arange(len(unique_coordinates.index))},
+                              geometry=gpd.points_from_xy(unique_coordinates['x'], unique_coordinates['y']), crs=df2.crs)
+    shapes = [c for c in geodf.columns if c != 'geometry']
+    matches = sjoin_within(points, geodf, how='inner')[['point_id'] + shapes]
+    results = pd.DataFrame(df2.drop(columns='geometry')).assign(point_id=point_ids)
+    results = results.merge(matches, on='point_id', how='left', suffixes=('_left', '_right'))
     if same_file == 'yes':
         output_cols = df1.columns.tolist() + target_cols
     else:
@@ -295,24 +321,53 @@ if __name__ == '__main__':
     # override and fill empty state data points
     # df1['ADM1_PT'] = df1['state'].apply(lambda x: state_codes[x] if x in state_codes else x)
 
+    # similarity scores from previous runs
+    scores = {}
+    new_scores = 0
+    if match_cache not in ['', None] and os.path.isfile(match_cache):
+        for line in open(match_cache, encoding='utf-8').readlines():
+            if not line.startswith('#'):
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) == 3:
+                    scores[(fields[0], fields[1])] = float(fields[2])
+
     def similar(a, b):
-        return SequenceMatcher(None, a, b).ratio()
+        global new_scores
+        if a == b:
+            return 1.0
+        if (a, b) not in scores:
+            matcher = SequenceMatcher(None, a, b)
+            # quick ratios are upper bounds of the similarity: below the lowest threshold, both thresholds reject the pair
+            score = matcher.real_quick_ratio()
+            if score >= min_threshold:
+                score = matcher.quick_ratio()
+                if score >= min_threshold:
+                    score = matcher.ratio()
+            scores[(a, b)] = score
+            new_scores += 1
+        return scores[(a, b)]
 
     mismatches = []
     if check_col not in [None, '']:
-        for id2, row2 in results.iterrows():
-            # print(results[last_level])
-            orig_name = results.loc[id2, last_level]
-            new_name = results.loc[id2, check_col]
+        # each pair of names is compared once, in order of appearance. The threshold only decreases, so later
+        # occurrences of a pair cannot produce a mismatch that its first occurrence did not produce
+        mismatched = set()
+        for orig_name, new_name in results[[last_level, check_col]].drop_duplicates().itertuples(index=False):
             # print(orig_name, ' >>> ', new_name, ':', str(similar(orig_name, new_name)))
             if len(str(new_name)) <= 4:
-                threshold = 0.65
+                threshold = min_threshold
             if similar(str(orig_name).lower(), str(new_name).lower()) < threshold:
                 # print(orig_name, ' >>> ', new_name, ':', str(similar(orig_name, new_name)))
                 entry = str(orig_name) + ' > ' + str(new_name)
-                if entry not in mismatches:
+                if entry not in mismatched:
+                    mismatched.add(entry)
                     mismatches.append(entry)
-                # results = results.drop(id2)
+
+        if match_cache not in ['', None] and new_scores > 0:
+            with open(match_cache, 'w', encoding='utf-8') as outfile:
+                outfile.write('# original name\tshapefile name\tsimilarity\n')
+                for (a, b), score in scores.items():
+                    outfile.write(a + '\t' + b + '\t' + repr(score) + '\n')
 
     if len(mismatches) > 0:
         print('\nWARNING!\nMismatches between the original location names and names in shapefiles were detected.\n'
@@ -6,12 +6,12 @@
 # Last update: 2023-03-02
 
 
-import pycountry_convert as pyCountry
-import pycountry
-from Bio import SeqIO
+from country_codes import CountryCodes
+from fasta_index import FastaIndex
 import pandas as pd
 import time
 import argparse
+import os
 
 pd.set_option('display.max_columns', 500)
 
@@ -29,6 +29,7 @@ if __name__ == '__main__':
     parser.add_argument("--end-date", required=False, type=str,  help="End date in YYYY-MM-DD format")
     parser.add_argument("--filter1", required=False, type=str, help="Filter for contextual metadata. Format: '~column_name:value'. Remove '~' to keep only that data category")
     parser.add_argument("--filter2", required=False, type=str, help="Filter for new metadata. Format: '~column_name:value'. Remove '~' to keep only that data category")
+    parser.add_argument("--iso-cache", required=False, help="TSV file caching ISO codes of country names found by fuzzy searches")
     parser.add_argument("--output1", required=True, help="Final metadata file")
     parser.add_argument("--output2", required=True, help="Final FASTA file")
     parser.add_argument("--output3", required=False, help="IQTree renaming list")
@@ -42,6 +43,7 @@ if __name__ == '__main__':
     end_date = args.end_date
     filter1 = args.filter1
     filter2 = args.filter2
+    iso_cache = args.iso_cache
     output1 = args.output1
     output2 = args.output2
     output3 = args.output3
@@ -78,20 +80,9 @@ if __name__ == '__main__':
 
 
     # get ISO alpha3 country codes
-    isos = {'': ''}
+    country_resolver = CountryCodes(iso_cache)
     def get_iso(country):
-        global isos
-        if country not in isos.keys():
-            try:
-                isoCode = pyCountry.country_name_to_country_alpha3(country, cn_name_format="default")
-                isos[country] = isoCode
-            except:
-                try:
-                    isoCode = pycountry.countries.search_fuzzy(country)[0].alpha_3
-                    isos[country] = isoCode
-                except:
-                    isos[country] = ''
-        return isos[country]
+        return country_resolver.alpha3(country)
 
     # contextual metadata
     dfN = load_table(metadata1)
@@ -213,15 +204,13 @@ if __name__ == '__main__':
     # print(dfE)
 
     # list of relevant genomes sequenced
-    keep_only = dfE['strain'].tolist()
-    excluded = [id for id in new_sequences if id not in keep_only]
+    keep_only = set(dfE['strain'].tolist())
+    excluded = set(id for id in new_sequences if id not in keep_only)
 
-    # create a dict of existing sequences
-    sequences = {}
-    for fasta in SeqIO.parse(open(genomes), 'fasta'):  # as fasta:
-        id, seq = fasta.description, fasta.seq
-        if id not in sequences.keys() and id not in excluded:
-            sequences[id] = str(seq)
+    # index existing sequences, which are only loaded at export time
+    fasta_index = FastaIndex(genomes)
+    sequences = [id for id in fasta_index if id not in excluded]
+    sequence_ids = set(sequences)
 
     # print(dfN)
 
@@ -231,63 +220,24 @@ if __name__ == '__main__':
         if col not in dfE.columns:
             dfE[col] = ''
 
-    # output dataframe
-    found = []
-    outputDF = pd.DataFrame(columns=metadata1_columns)
-
     # process contextual metadata
-    dfN = dfN[dfN['strain'].isin(sequences.keys())] # filter only samples included in fasta file
-    for idx, row in dfN.iterrows():
-        # print(row)
-        strain = dfN.loc[idx, 'strain']#.replace('hCoV-19/', '')
-        # print(strain)
-
-        if strain in sequences:
-            if strain in outputDF['strain'].to_list():
-                continue
-            dict_row = {}
-            date = ''
-            for col in metadata1_columns:
-                if col == 'date':
-                    date = dfN.loc[idx, col]
-                dict_row[col] = ''
-                if col in row:
-                    dict_row[col] = dfN.loc[idx, col]
-
-            dict_row['country_code'] = get_iso(dict_row['country'])
-            found.append(strain)
-
-            dfR = pd.DataFrame([dict_row])
-            # print(dfR)
-            frames = [outputDF, dfR]
-            outputDF = pd.concat(frames, ignore_index=True)
-    # print(outputDF)
+    dfN = dfN[dfN['strain'].isin(sequence_ids)] # filter only samples included in fasta file
+    dfN = dfN.drop_duplicates(subset='strain', keep='first')[metadata1_columns]
 
     # process metadata from newly sequenced samples
-    metadata_issues = {}
-    new_samples = []
-    for idx, row in dfE.iterrows():
-        id = dfE.loc[idx, 'strain']#.replace('hCoV-19/', '')
-        if id in sequences:
-            dict_row = {}
-            for col in metadata1_columns:
-                dict_row[col] = ''
-                if col in row:
-                    dict_row[col] = dfE.loc[idx, col].strip()  # add values to dictionary
-
-            # set the strain name
-            dict_row['country_code'] = get_iso(dict_row['country'])
-
-            # record sequence and metadata as found
-            found.append(id)
-            dfR = pd.DataFrame([dict_row])
-
-            # register new samples
-            if id not in new_samples:
-                new_samples.append(id)
-
-            frames = [outputDF, dfR]
-            outputDF = pd.concat(frames, ignore_index=True)
+    dfE = dfE[dfE['strain'].isin(sequence_ids)][metadata1_columns]
+    dfE = dfE.apply(lambda column: column.str.strip())  # remove flanking spaces from all values
+
+    # register new samples
+    new_samples = dfE['strain'].drop_duplicates().tolist()
+
+    # output dataframe
+    outputDF = pd.concat([dfN, dfE], ignore_index=True)
+
+    # set the country codes, searching each country only once
+    country_codes = {country: get_iso(country) for country in outputDF['country'].unique()}
+    outputDF['country_code'] = outputDF['country'].map(country_codes)
+    country_resolver.save()
 
     # print(outputDF)
 
@@ -298,28 +248,23 @@ if __name__ == '__main__':
     # write new metadata files
     outputDF.to_csv(output1, sep='\t', index=False)
 
-    # write sequence file
-    # export new metadata lines
-    outfile2 = open(output2, 'w')
-    outfile3 = open(output3, 'w')
-    exported = []
-
-    for id, sequence in sequences.items():
-        if id in new_samples: # export newly generated sequences
-            if id not in exported:
+    # write sequence file and renaming list
+    buffer_size = 1024 * 1024
+    new_samples = set(new_samples)
+    output_strains = set(outputDF['strain'])
+    exported = set()
+    with open(output2, 'w', buffering=buffer_size) as outfile2, \
+            open(output3 if output3 else os.devnull, 'w', buffering=buffer_size) as outfile3:
+        for id in sequences:
+            # export newly generated sequences, and contextual sequences with metadata
+            if id not in exported and (id in new_samples or id in output_strains):
+                sequence = fasta_index.fetch(id)
                 entry = '>' + id + '\n' + sequence + '\n'
                 outfile2.write(entry)
                 new_id = id.replace('/', '_')
                 outfile3.write(new_id + '\t' + id + '\n')
-                exported.append(id)
+                exported.add(id)
 
-        else:  # export contextual sequences
-            if id not in exported and id in outputDF['strain'].tolist():
-                # print(id)
-                entry = '>' + id + '\n' + sequence + '\n'
-                outfile2.write(entry)
-                new_id = id.replace('/', '_')
-                outfile3.write(new_id + '\t' + id + '\n')
-                exported.append(id)
+    fasta_index.close()
 
     print('\nMetadata file successfully processed and exported!\n')
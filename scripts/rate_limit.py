@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+
+"""
+Request throttling shared by scripts that query web services (Nominatim, NCBI)
+"""
+
+import threading
+import time
+
+
+class RateLimiter:
+    """ Space out calls made by any number of threads, to at most 'rate' calls per second """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.lock = threading.Lock()
+        self.next_call = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
@@ -2,6 +2,7 @@
 
 from Bio import Phylo
 from Bio import SeqIO
+from fasta_index import FastaIndex
 import argparse
 
 
@@ -27,6 +28,7 @@ if __name__ == '__main__':
 
 
     targets = [target.strip() for target in open(list, "r").readlines() if target[0] not in ['\n', '#']]
+    target_ids = set(targets)  # hashed lookups when filtering records
     if format == 'tree':
         tree = Phylo.read(input, 'newick')
         print('Starting tree file processing...')
@@ -107,7 +109,7 @@ if __name__ == '__main__':
                 replacements[old] = new
 
             # perform simple renaming
-            found = []
+            found = set()
             not_found = []
             duplicates = []
             c = 1
@@ -119,7 +121,7 @@ if __name__ == '__main__':
                             entry = ">" + replacements[id] + "\n" + str(seq).upper() + "\n"
                             print(str(c) + '. Renamed - ' + replacements[id])
                             outfile.write(entry)
-                            found.append(replacements[id])
+                            found.add(replacements[id])
                             c += 1
                         else:
                             print('Duplicate found: ' + replacements[id])
@@ -139,32 +141,28 @@ if __name__ == '__main__':
             print('\n### A total of ' + str(len(found)) + ' sequences were renamed \n')
 
         if action in ['keep', 'remove']:
-            found = []  # store all found headers
-            record_dict = {}
-            for fasta in SeqIO.parse(open(input), 'fasta'):
-                id, seq = fasta.description, fasta.seq
-                if id not in record_dict.keys():
-                    record_dict[id] = str(seq)
+            found = set()  # store all found headers
+            record_dict = FastaIndex(input)  # unique headers, sequences are loaded when exported
 
             count = 1
             with open(output, 'w') as outfile:
-                for header in record_dict.keys():
-                    if action == 'keep':
-                        if header not in found and header in targets:
-                            found.append(header)
-                            entry = ">" + header + "\n" + str(record_dict[header]).upper() + "\n"
-                            outfile.write(entry)
-                            print(str(count) + '/' + str(len(targets)) + " - Filtering sequence... " + header)
-                            count += 1
-
-                    if action == 'remove':  # remove selected sequences
-                        if header not in targets and header not in found:
-                            entry = ">" + header + "\n" + str(record_dict[header]).upper() + "\n"
+                if action == 'keep':
+                    for header, seq in record_dict.iter_selected(target_ids):
+                        found.add(header)
+                        entry = ">" + header + "\n" + seq.upper() + "\n"
+                        outfile.write(entry)
+                        print(str(count) + '/' + str(len(targets)) + " - Filtering sequence... " + header)
+                        count += 1
+
+                if action == 'remove':  # remove selected sequences
+                    for header in record_dict:
+                        if header not in target_ids and header not in found:
+                            entry = ">" + header + "\n" + record_dict.fetch(header).upper() + "\n"
                             outfile.write(entry)
                         else:
                             print(str(count) + '/' + str(len(targets)) + " - Removing sequence... " + header)
                             count += 1
-                            found.append(header)
+                            found.add(header)
 
                 def Diff(list1, list2):  # compare full list of headers and those found in the previous step. Flag any headers not found
                     notFound = set(list1) - set(list2)
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+"""
+Shapefile layers prepared for point-in-polygon searches, cached as pickles.
+
+Cache files are named after the content hash of the shapefile (and all its
+sidecar files), and the projection requested, so that edited shapefiles are
+read again, and repeated runs skip parsing and reprojecting the polygons.
+"""
+
+import hashlib
+import os
+import pickle
+import geopandas as gpd
+
+SHAPEFILE_PARTS = ['.shp', '.shx', '.dbf', '.prj', '.cpg']
+
+
+def shapefile_hash(shapefile):
+    """ SHA1 digest of the content of a shapefile, including its sidecar files """
+    base, extension = os.path.splitext(shapefile)
+    parts = [base + part for part in SHAPEFILE_PARTS] if extension.lower() == '.shp' else [shapefile]
+
+    digest = hashlib.sha1()
+    for part in parts:
+        if os.path.isfile(part):
+            digest.update(os.path.basename(part).encode('utf-8'))
+            with open(part, 'rb') as infile:
+                for block in iter(lambda: infile.read(1 << 20), b''):
+                    digest.update(block)
+    return digest.hexdigest()
+
+
+def load_layer(shapefile, epsg=None, cache_dir=None):
+    """ Load a shapefile as a GeoDataFrame, optionally reprojected, with its spatial index (STRtree) built """
+    cache_file = None
+    if cache_dir not in ['', None]:
+        name = os.path.splitext(os.path.basename(shapefile))[0] + '.' + shapefile_hash(shapefile)
+        if epsg is not None:
+            name += '.epsg' + str(epsg)
+        cache_file = os.path.join(cache_dir, name + '.pkl')
+
+    if cache_file is not None and os.path.isfile(cache_file):
+        with open(cache_file, 'rb') as infile:
+            layer = pickle.load(infile)
+    else:
+        layer = gpd.read_file(shapefile)
+        if epsg is not None:
+            layer = layer.to_crs(epsg=epsg)
+        if cache_file is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(cache_file + '.tmp', 'wb') as outfile:
+                pickle.dump(layer, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(cache_file + '.tmp', cache_file)
+
+    layer.sindex  # build the STRtree (pickled trees only store their geometries, and are rebuilt when loaded anyway)
+    return layer
+
+
+def sjoin_within(points, layer, how='left'):
+    """ Spatial join of points within polygons, compatible with geopandas versions before and after 0.10 """
+    try:
+        return gpd.sjoin(points, layer, how=how, predicate='within')
+    except TypeError:
+        return gpd.sjoin(points, layer, how=how, op='within')
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+"""
+End-to-end check of download_ncbi_data.py against the local E-utilities stub (eutils_stub.py).
+
+Two downloads are run in a temporary directory, with existing FASTA and
+metadata files covering part of the records:
+    1. against a stub without failures;
+    2. against a stub where a fraction of requests fail (HTTP 502), or return
+       truncated GenBank batches, retried by the client.
+
+Both runs must export every missing record, with the sequence and source
+qualifiers served by the stub, and produce identical files.
+
+Usage:
+    python scripts/test_download_ncbi_data.py --records 1500 --fail-rate 0.3
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import pandas as pd
+from Bio import SeqIO
+from io import StringIO
+from eutils_stub import EutilsStub, make_records
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'download_ncbi_data.py')
+
+
+def run_download(url, workdir, name, args):
+    """ Run download_ncbi_data.py in separate mode, returning its log """
+    command = [sys.executable, SCRIPT, '--taxid', '1', '--genome-size', '100', '--min-size', '0.5', '--max-size', '2.0',
+               '--fasta', 'existing.fasta', '--metadata', 'existing.tsv', '--mode', 'separate',
+               '--eutils-url', url, '--batch-size', str(args.batch_size), '--page-size', str(args.page_size),
+               '--workers', str(args.workers), '--retries', str(args.retries),
+               '--output1', name + '.fasta', '--output2', name + '.tsv']
+    process = subprocess.run(command, cwd=workdir, capture_output=True, text=True)
+    if process.returncode != 0:
+        print(process.stdout + process.stderr)
+        raise SystemExit('download_ncbi_data.py failed (' + name + ')')
+    return process.stdout
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Test download_ncbi_data.py against a local E-utilities stub, with and without failures",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--records", required=False, type=int, default=1500, help="Number of synthetic records")
+    parser.add_argument("--fail-rate", required=False, type=float, default=0.3, help="Fraction of failed or truncated requests in the second run")
+    parser.add_argument("--batch-size", required=False, type=int, default=100, help="Number of GenBank records downloaded per request")
+    parser.add_argument("--page-size", required=False, type=int, default=600, help="Number of search results inspected per cycle")
+    parser.add_argument("--workers", required=False, type=int, default=3, help="Number of batches downloaded concurrently")
+    parser.add_argument("--retries", required=False, type=int, default=6, help="Number of retries of failed requests")
+    args = parser.parse_args()
+
+    records = make_records(args.records)
+    accessions = [accession.split('.')[0] for accession, qualifiers, text in records]
+    sequences = {accession.split('.')[0]: str(next(SeqIO.parse(StringIO(text), 'gb')).seq) for accession, qualifiers, text in records}
+    qualifiers = {accession.split('.')[0]: values for accession, values, text in records}
+
+    errors = []
+    with tempfile.TemporaryDirectory() as workdir:
+        # existing files: every 7th record has a sequence, every 13th has metadata
+        with open(os.path.join(workdir, 'existing.fasta'), 'w') as outfile:
+            for accno in accessions[::7]:
+                outfile.write('>' + accno + '\n' + sequences[accno] + '\n')
+        pd.DataFrame({'genbank': accessions[::13], 'id': accessions[::13]}).to_csv(os.path.join(workdir, 'existing.tsv'), sep='\t', index=False)
+
+        logs = {}
+        stubs = {'clean': 0.0, 'failing': args.fail_rate}
+        for name, fail_rate in stubs.items():
+            stub = EutilsStub(records, fail_rate=fail_rate).start()
+            print('Downloading ' + str(args.records) + ' records from the stub, with ' + str(int(fail_rate * 100)) + '% failed requests...')
+            logs[name] = run_download(stub.url, workdir, name, args)
+            stub.stop()
+            print('\t- ' + str(stub.failures) + ' requests failed or were truncated')
+            if fail_rate > 0 and stub.failures == 0:
+                errors.append('no failures were injected in the ' + name + ' run')
+
+        # every missing sequence is exported once, as served
+        exported = {record.id: str(record.seq) for record in SeqIO.parse(os.path.join(workdir, 'clean.fasta'), 'fasta')}
+        expected = [accno for accno in accessions if accno not in set(accessions[::7])]
+        if sorted(exported) != sorted(expected):
+            errors.append('exported sequences differ from the missing ones: ' + str(len(exported)) + ' exported, ' + str(len(expected)) + ' expected')
+        if any(exported[accno] != sequences[accno] for accno in exported if accno in sequences):
+            errors.append('exported sequences differ from the records served')
+
+        # every missing metadata row is exported once, with the source qualifiers served
+        dfM = pd.read_csv(os.path.join(workdir, 'clean.tsv'), sep='\t', dtype=str).fillna('')
+        expected = [accno for accno in accessions if accno not in set(accessions[::13])]
+        if sorted(dfM['genbank']) != sorted(expected):
+            errors.append('exported metadata rows differ from the missing ones: ' + str(len(dfM)) + ' exported, ' + str(len(expected)) + ' expected')
+        for accno, country, host in zip(dfM['genbank'], dfM['country'], dfM['host']):
+            if qualifiers[accno]['country'][0].split(':')[0] != country or qualifiers[accno]['host'][0] != host:
+                errors.append('metadata of ' + accno + ' differs from the record served')
+                break
+
+        # retried downloads give the same files
+        for extension in ['.fasta', '.tsv']:
+            if open(os.path.join(workdir, 'clean' + extension)).read() != open(os.path.join(workdir, 'failing' + extension)).read():
+                errors.append('outputs with and without failures differ: ' + extension)
+        for name, log in logs.items():
+            if 'failed' in log or 'not retrieved' in log:
+                errors.append('some batches or entries were not retrieved in the ' + name + ' run')
+
+    if len(errors) > 0:
+        print('\nFAILED:')
+        for error in errors:
+            print('\t- ' + error)
+        sys.exit(1)
+    print('\nAll checks passed.\n')